@@ -7,20 +7,38 @@ import flask
 def create_app(test_config=None):
     app = flask.Flask(__name__, instance_relative_config=True)
     app.config.from_pyfile('config.py')
+    if test_config is not None:
+        app.config.update(test_config)
     app.config['DEV'] = 'FLASK_ENV' in environ and environ['FLASK_ENV'] == 'development'
+    if app.config.get('MAX_CONTENT_LENGTH') is None:
+        app.config['MAX_CONTENT_LENGTH'] = 16*1024**2
     for key in ['LIBRARY', 'PIL_FONT', 'FF_FONT_DIR']:
-        app.config[key] = Path(app.instance_path)/app.config[key]
+        if key in app.config:
+            app.config[key] = Path(app.instance_path)/app.config[key]
+    for library in (app.config.get('LIBRARIES') or {}).values():
+        library['LIBRARY'] = Path(app.instance_path)/library['LIBRARY']
 
     try:
         makedirs(app.instance_path)
     except OSError:
         pass
 
+    import knowledgeseeker.shows as shows
+    prefix = shows.url_prefix(app)
+
     import knowledgeseeker.clips as clips
-    app.register_blueprint(clips.bp)
+    app.register_blueprint(clips.bp, url_prefix=prefix)
 
     import knowledgeseeker.webui as webui
-    app.register_blueprint(webui.bp)
+    app.register_blueprint(webui.bp, url_prefix=prefix)
+
+    import knowledgeseeker.framesearch as framesearch
+    app.register_blueprint(framesearch.bp, url_prefix=prefix)
+
+    import knowledgeseeker.autocomplete as autocomplete
+    app.register_blueprint(autocomplete.bp, url_prefix=prefix)
+
+    shows.init_app(app)
 
     import knowledgeseeker.library as library
     library.init_app(app)
@@ -28,5 +46,29 @@ def create_app(test_config=None):
     import knowledgeseeker.database as database
     database.init_app(app)
 
+    import knowledgeseeker.pagecache as pagecache
+    pagecache.init_app(app)
+
+    import knowledgeseeker.cli as cli
+    cli.init_app(app)
+
+    if app.config.get('PRELOAD', False):
+        warm_up(app)
+
     return app
 
+
+def warm_up(app):
+    # Open the database and fill caches before the worker takes traffic.
+    import knowledgeseeker.autocomplete as autocomplete
+    import knowledgeseeker.database as database
+    import knowledgeseeker.framesearch as framesearch
+    import knowledgeseeker.pagecache as pagecache
+    for show in list(app.config.get('LIBRARIES') or {}) or [None]:
+        with app.app_context():
+            flask.g.show = show
+            if not database.get_path().exists():
+                continue
+            pagecache.warm_up()
+            framesearch.get_index()
+            autocomplete.get_index()
@@ -0,0 +1,183 @@
+import asyncio
+import io
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from knowledgeseeker import create_app
+from knowledgeseeker.mediacache import DEFER_ENVIRON_KEY, DeferredRun
+
+
+MAX_DISPATCHES = 3
+
+
+def create_asgi_app(test_config=None):
+    app = create_app(test_config)
+    return AsgiApp(app,
+                   threads=app.config.get('ASGI_THREADS', 8),
+                   max_transcodes=app.config.get('ASGI_MAX_TRANSCODES', None))
+
+
+class AsgiApp(object):
+    # Runs Flask views (SQLite, PIL, Jinja) on a bounded thread pool, but runs
+    # ffmpeg as asyncio subprocesses so that slow transcodes hold no threads.
+
+    def __init__(self, app, threads=8, max_transcodes=None):
+        self.app = app
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._transcodes = (asyncio.Semaphore(max_transcodes)
+                            if max_transcodes is not None else None)
+        self._running = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    async def _http(self, scope, receive, send):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        # A view that needs ffmpeg output that isn't cached yet hands us the
+        # command; run it, then dispatch again to serve the result.
+        loop = asyncio.get_running_loop()
+        for _ in range(MAX_DISPATCHES):
+            status, headers, app_iter = await loop.run_in_executor(
+                self._executor, self._dispatch, make_environ(scope, body))
+            if not isinstance(app_iter, DeferredRun):
+                break
+            if not await self._run(app_iter):
+                status, headers, app_iter = error_response()
+                break
+        else:
+            status, headers, app_iter = error_response()
+
+        await send({ 'type': 'http.response.start',
+                     'status': status,
+                     'headers': headers })
+        try:
+            while True:
+                chunk = await loop.run_in_executor(
+                    self._executor, next, app_iter, None)
+                if chunk is None:
+                    break
+                await send({ 'type': 'http.response.body',
+                             'body': chunk,
+                             'more_body': True })
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        await send({ 'type': 'http.response.body', 'body': b'' })
+
+    def _dispatch(self, environ):
+        # Same as Flask.wsgi_app, but hands back deferred ffmpeg runs.
+        with self.app.request_context(environ):
+            try:
+                response = self.app.full_dispatch_request()
+            except DeferredRun as e:
+                return None, None, e
+            except Exception as e:
+                response = self.app.handle_exception(e)
+            app_iter, status, headers = response.get_wsgi_response(environ)
+        return (int(status.split(' ', 1)[0]),
+                [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                 for name, value in headers],
+                iter(app_iter))
+
+    async def _run(self, deferred):
+        # Requests for the same file share one ffmpeg process.
+        task = self._running.get(deferred.key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_process(deferred))
+            self._running[deferred.key] = task
+            task.add_done_callback(
+                lambda _: self._running.pop(deferred.key, None))
+        return await asyncio.shield(task)
+
+    async def _run_process(self, deferred):
+        loop = asyncio.get_running_loop()
+        if self._transcodes is not None:
+            await self._transcodes.acquire()
+        try:
+            stderr = None if self.app.config.get('DEV') else subprocess.DEVNULL
+            process = await asyncio.create_subprocess_exec(
+                *deferred.args, stdout=subprocess.DEVNULL, stderr=stderr)
+            returncode = await process.wait()
+        except OSError:
+            # ffmpeg missing, out of file descriptors, ...
+            returncode = None
+        finally:
+            if self._transcodes is not None:
+                self._transcodes.release()
+
+        def complete():
+            with self.app.app_context():
+                if returncode == 0:
+                    deferred.finish()
+                else:
+                    deferred.cleanup()
+        await loop.run_in_executor(self._executor, complete)
+        return returncode == 0
+
+
+def error_response():
+    return (500,
+            [(b'content-type', b'text/plain; charset=utf-8')],
+            iter([b'media could not be generated']))
+
+
+def make_environ(scope, body):
+    def latin1(s):
+        return s.encode('utf-8').decode('latin-1')
+
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path != '' and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': latin1(root_path),
+        'PATH_INFO': latin1(path),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        DEFER_ENVIRON_KEY: True
+    }
+    if scope.get('client') is not None:
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = 'HTTP_%s' % name
+        if key in environ:
+            environ[key] += ',' + value
+        else:
+            environ[key] = value
+    return environ
@@ -0,0 +1,104 @@
+import re
+import threading
+from collections import Counter, OrderedDict
+
+import flask
+
+from knowledgeseeker.database import get_db, get_generation, get_shows
+from knowledgeseeker.utils import strip_html
+from knowledgeseeker.webui import clean_query
+
+
+bp = flask.Blueprint('autocomplete', __name__)
+
+N_TERMS = 8
+N_MOMENTS = 5
+MIN_PREVIEW_LENGTH = 2
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_index():
+    generation = get_generation()
+    with _lock:
+        index = _indexes.get(generation)
+        if index is not None:
+            _indexes.move_to_end(generation)
+            return index
+
+        # The FTS index holds porter stems ("happen" for "happened"), so build
+        # the vocabulary from the raw subtitle text instead of fts5vocab, split
+        # the same way as the ascii tokenizer does.
+        cur = get_db().cursor()
+        cur.execute('SELECT content FROM subtitle_search')
+        counts = Counter()
+        for row in cur.fetchall():
+            text = strip_html(row['content']).lower()
+            counts.update(re.findall(r'[a-z0-9]+', text))
+
+        index = {}
+        for term, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            for i in range(1, len(term) + 1):
+                terms = index.setdefault(term[:i], [])
+                if len(terms) < N_TERMS:
+                    terms.append(term)
+        if generation is not None:
+            # One per show, plus one while a show's new build takes over.
+            _indexes[generation] = index
+            while len(_indexes) > len(get_shows()) + 1:
+                _indexes.popitem(last=False)
+        return index
+
+
+@bp.route('/autocomplete')
+def complete():
+    # Suggestions only change with the database, so let browsers keep them
+    # and revalidate against its generation, rather than expire on a timer.
+    generation = get_generation()
+    if (generation is not None
+            and flask.request.if_none_match.contains(generation)):
+        return cached_response(flask.Response(status=304), generation)
+
+    query = clean_query(flask.request.args.get('q')).lower()
+    words = re.findall(r'[a-z0-9]+', query)
+    if len(words) == 0 or not query[-1].isalnum():
+        return cached_response(flask.jsonify(terms=[], moments=[]), generation)
+    head, last = words[:-1], words[-1]
+
+    terms = [' '.join(head + [term]) for term in get_index().get(last, [])]
+
+    moments = []
+    if len(last) >= MIN_PREVIEW_LENGTH:
+        cur = get_db().cursor()
+        cur.execute('PRAGMA full_column_names = ON')
+        cur.execute(
+            '    SELECT episode.slug, season.slug, search.snapshot_ms, search.content '
+            '           FROM season '
+            'INNER JOIN episode ON episode.season_id = season.id '
+            'INNER JOIN (SELECT episode_id, snapshot_ms, content FROM subtitle_search '
+            '             WHERE content MATCH :query LIMIT :n_moments) search '
+            '           ON search.episode_id = episode.id',
+            { 'query': ' '.join(['"%s"' % word for word in head] + ['"%s"*' % last]),
+              'n_moments': N_MOMENTS })
+        for row in cur.fetchall():
+            slug_kwargs = { 'season': row['season.slug'],
+                            'episode': row['episode.slug'],
+                            'ms': row['search.snapshot_ms'] }
+            moments.append({
+                'season': row['season.slug'],
+                'episode': row['episode.slug'],
+                'ms': row['search.snapshot_ms'],
+                'content': row['search.content'],
+                'url': flask.url_for('webui.browse_moment', **slug_kwargs),
+                'tiny': flask.url_for('clips.snapshot_tiny', **slug_kwargs) })
+        cur.execute('PRAGMA full_column_names = OFF')
+    return cached_response(flask.jsonify(terms=terms, moments=moments),
+                           generation)
+
+
+def cached_response(response, generation):
+    if generation is not None:
+        response.set_etag(generation)
+        response.cache_control.no_cache = True
+    return response
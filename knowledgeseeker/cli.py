@@ -0,0 +1,28 @@
+import click
+from flask.cli import with_appcontext
+
+from knowledgeseeker.library import show_option
+
+
+def init_app(app):
+    app.cli.add_command(load_test_command)
+
+
+@click.command('load-test')
+@click.option('--synthetic', is_flag=True,
+              help='Generate a small library instead of using the real one.')
+@click.option('--rate', default=50.0, help='Requests per second to send.')
+@click.option('--duration', default=30.0, help='Seconds to send them for.')
+@click.option('--concurrency', default=16,
+              help='Most requests to have in flight at once.')
+@click.option('--mix', default=None,
+              help='Comma-separated route=weight pairs.')
+@click.option('--seed', default=0, help='Seed for picking requests.')
+@with_appcontext
+@show_option
+def load_test_command(synthetic, rate, duration, concurrency, mix, seed):
+    # The harness pulls in a server, urllib and PIL, which web workers can do
+    # without.
+    import knowledgeseeker.loadtest as loadtest
+    loadtest.load_test(synthetic, rate, duration, concurrency,
+                       mix or loadtest.DEFAULT_MIX, seed)
@@ -2,14 +2,17 @@ import flask
 import io
 import textwrap as tw
 from base64 import b64decode
+from bisect import bisect_left
 from datetime import timedelta
 from pathlib import Path
 
 from PIL import Image, ImageDraw, ImageFont
 
 import knowledgeseeker.ffmpeg as ff
-from knowledgeseeker.database import get_db, match_episode
-from knowledgeseeker.utils import set_expires
+from knowledgeseeker.database import (get_db, get_generation, lazy_snapshots,
+                                      match_episode)
+from knowledgeseeker.mediacache import materialize, send_media
+from knowledgeseeker.utils import set_expires, unpack_keyframes
 
 
 bp = flask.Blueprint('clips', __name__)
@@ -17,41 +20,70 @@ bp = flask.Blueprint('clips', __name__)
 TEXT_VMARGIN = 0.1
 TEXT_SPACING = 4
 JPEG_QUALITY = 85
+RENDITIONS = { 'avif': 'image/avif', 'webp': 'image/webp' }
+MAX_BATCH = 100
+# Settings that change what ffmpeg renders.
+MEDIA_SETTINGS = ['GIF_VRES', 'WEBM_VRES', 'FF_FONT_DIR', 'FF_FONT_NAME',
+                  'FF_FONT_SIZE']
 
 
 @bp.route('/<season>/<episode>/<int:ms>/pic')
 @set_expires
 @match_episode
 def snapshot(season_id, episode_id, ms):
-    # Load PNG from database.
-    cur = get_db().cursor()
-    cur.execute(
-        'SELECT png FROM snapshot'
-        ' WHERE episode_id=:episode_id AND ms=:ms',
-        { 'episode_id': episode_id, 'ms': ms })
-    res = cur.fetchone()
-    if res is None:
-        flask.abort(404, 'time not found')
-    image = Image.open(io.BytesIO(res['png']))
-
-    # Draw text if requested.
     top_text = (b64decode(flask.request.args.get('topb64', ''))
         .decode('ascii', 'ignore'))
     bottom_text = (b64decode(flask.request.args.get('btmb64', ''))
         .decode('ascii', 'ignore'))
+
+    if lazy_snapshots():
+        vres = flask.current_app.config.get('JPEG_VRES')
+        if top_text == '' and bottom_text == '':
+            path = render_snapshot(episode_id, ms, vres, 'mjpeg')
+            return send_media(path, 'image/jpeg')
+        image = Image.open(render_snapshot(episode_id, ms, vres, 'png'))
+    else:
+        # Serve a pre-encoded rendition if the browser takes one.
+        if top_text == '' and bottom_text == '':
+            response = find_rendition(episode_id, ms, 'full')
+            if response is not None:
+                return response
+
+        # Load PNG from database.
+        cur = get_db().cursor()
+        cur.execute(
+            'SELECT png FROM snapshot'
+            ' WHERE episode_id=:episode_id AND ms=:ms',
+            { 'episode_id': episode_id, 'ms': ms })
+        res = cur.fetchone()
+        if res is None:
+            flask.abort(404, 'time not found')
+        image = Image.open(io.BytesIO(res['png']))
+
+    # Draw text if requested.
     if top_text != '' or bottom_text != '':
         drawtext(image, top_text, bottom_text)
 
     # Return as compressed JPEG.
     res = io.BytesIO()
     image.save(res, 'jpeg', quality=JPEG_QUALITY)
-    return flask.Response(res.getvalue(), mimetype='image/jpeg')
+    return blob_response(res.getvalue(), 'image/jpeg')
 
 
 @bp.route('/<season>/<episode>/<int:ms>/pic/tiny')
 @set_expires
 @match_episode
 def snapshot_tiny(season_id, episode_id, ms):
+    if lazy_snapshots():
+        path = render_snapshot(episode_id, ms,
+                               flask.current_app.config.get('JPEG_TINY_VRES'),
+                               'mjpeg')
+        return send_media(path, 'image/jpeg')
+
+    response = find_rendition(episode_id, ms, 'tiny')
+    if response is not None:
+        return response
+
     cur = get_db().cursor()
     cur.execute(
         'SELECT jpeg FROM snapshot_tiny '
@@ -60,7 +92,149 @@ def snapshot_tiny(season_id, episode_id, ms):
     res = cur.fetchone()
     if res is None:
         flask.abort(404, 'time not found')
-    return flask.Response(res['jpeg'], mimetype='image/jpeg')
+    return blob_response(res['jpeg'], 'image/jpeg')
+
+
+@bp.route('/pic/tiny')
+@set_expires
+def snapshot_tiny_batch():
+    # Many tiny snapshots, named by ?f=season/episode/ms, packed end to end.
+    # X-Offsets and X-Types give each one's start and type, in order;
+    # snapshots not found are left empty.
+    if lazy_snapshots():
+        flask.abort(404, 'snapshots are rendered on request')
+    frames = flask.request.args.getlist('f')
+    if len(frames) > MAX_BATCH:
+        flask.abort(400, 'too many snapshots requested')
+
+    cur = get_db().cursor()
+    cur.execute('PRAGMA full_column_names = ON')
+    cur.execute(
+        '    SELECT episode.id, episode.slug, season.slug FROM episode '
+        'INNER JOIN season ON season.id = episode.season_id')
+    episode_ids = { (row['season.slug'], row['episode.slug']): row['episode.id']
+                    for row in cur.fetchall() }
+    cur.execute('PRAGMA full_column_names = OFF')
+    keys = []
+    for frame in frames:
+        season, episode, ms = (frame.split('/') + ['', ''])[:3]
+        if not ms.isdigit():
+            flask.abort(400, 'bad snapshot: %s' % frame)
+        keys.append((episode_ids.get((season, episode)), int(ms)))
+
+    # Look everything up at once.
+    found = {}
+    wanted = [key for key in keys if key[0] is not None]
+    if wanted != []:
+        values = ', '.join(['(?, ?)']*len(wanted))
+        params = [value for key in wanted for value in key]
+        cur.execute(
+            'SELECT episode_id, ms, jpeg FROM snapshot_tiny '
+            ' WHERE (episode_id, ms) IN (VALUES %s)' % values,
+            params)
+        for row in cur.fetchall():
+            found[(row['episode_id'], row['ms'])] = (row['jpeg'], 'image/jpeg')
+        accepted = accepted_renditions()
+        if accepted != set():
+            cur.execute(
+                'SELECT episode_id, ms, format, data FROM snapshot_rendition '
+                " WHERE size='tiny' AND (episode_id, ms) IN (VALUES %s)" % values,
+                params)
+            renditions = {}
+            for row in cur.fetchall():
+                # Send whichever acceptable rendition is smallest.
+                key = (row['episode_id'], row['ms'])
+                best = renditions.get(key)
+                if (row['format'] in accepted
+                        and (best is None or len(row['data']) < len(best[0]))):
+                    renditions[key] = (row['data'], RENDITIONS[row['format']])
+            found.update(renditions)
+
+    parts = [found.get(key, (b'', '')) for key in keys]
+    offsets = []
+    offset = 0
+    for data, _ in parts:
+        offsets.append(offset)
+        offset += len(data)
+    response = blob_response(b''.join(data for data, _ in parts),
+                             'application/octet-stream')
+    response.headers.set('X-Offsets', ','.join(map(str, offsets)))
+    response.headers.set('X-Types', ','.join(mimetype for _, mimetype in parts))
+    return response
+
+
+@bp.route('/<season>/<episode>/sprites/<int:idx>')
+@set_expires
+@match_episode
+def sprite_sheet(season_id, episode_id, idx):
+    cur = get_db().cursor()
+    cur.execute(
+        'SELECT jpeg FROM sprite_sheet '
+        ' WHERE episode_id=:episode_id AND idx=:idx',
+        { 'episode_id': episode_id, 'idx': idx })
+    res = cur.fetchone()
+    if res is None:
+        flask.abort(404, 'sprite sheet not found')
+    return blob_response(res['jpeg'], 'image/jpeg')
+
+
+def render_snapshot(episode_id, ms, vres, codec):
+    cur = get_db().cursor()
+    cur.execute('SELECT video_path, duration FROM episode WHERE id=:episode_id',
+                { 'episode_id': episode_id })
+    res = cur.fetchone()
+    if ms >= res['duration']:
+        flask.abort(404, 'time not found')
+    video_path = res['video_path']
+    extension = 'jpg' if codec == 'mjpeg' else codec
+    return materialize(
+        media_key('snapshot', video_path, ms, vres, codec), extension,
+        lambda output: ff.snapshot_stream(video_path, ms, vres, output,
+                                          codec=codec))
+
+
+def media_key(*parts):
+    # Rendered files outlive the process, so key them by the database and the
+    # settings they were made with as well.
+    config = flask.current_app.config
+    return parts + (get_generation(),) + tuple(str(config.get(key))
+                                               for key in MEDIA_SETTINGS)
+
+
+def accepted_renditions():
+    # Browsers send */*, so only formats they name explicitly count.
+    accepted = set(value for value, quality in flask.request.accept_mimetypes
+                   if quality > 0)
+    return set(fmt for fmt, mimetype in RENDITIONS.items()
+               if mimetype in accepted)
+
+
+def find_rendition(episode_id, ms, size):
+    accepted = accepted_renditions()
+    if accepted == set():
+        return None
+
+    cur = get_db().cursor()
+    cur.execute(
+        'SELECT format, data FROM snapshot_rendition '
+        ' WHERE episode_id=:episode_id AND ms=:ms AND size=:size',
+        { 'episode_id': episode_id, 'ms': ms, 'size': size })
+    candidates = [row for row in cur.fetchall() if row['format'] in accepted]
+    if candidates == []:
+        return None
+
+    # Send whichever acceptable rendition is smallest.
+    best = min(candidates, key=lambda row: len(row['data']))
+    return blob_response(best['data'], RENDITIONS[best['format']])
+
+
+def blob_response(data, mimetype):
+    # Honor Range and conditional requests for in-memory images.
+    response = flask.Response(data, mimetype=mimetype)
+    response.vary.add('Accept')
+    response.add_etag()
+    return response.make_conditional(flask.request, accept_ranges=True,
+                                     complete_length=len(data))
 
 
 def drawtext(image, top_text, bottom_text):
@@ -101,12 +275,17 @@ def gif(season_id, episode_id, ms1, ms2):
         flask.abort(400, 'bad time range')
 
     cur = get_db().cursor()
-    cur.execute('SELECT video_path FROM episode WHERE id=:episode_id',
-                { 'episode_id': episode_id })
+    cur.execute(
+        'SELECT video_path, fps, keyframes FROM episode WHERE id=:episode_id',
+        { 'episode_id': episode_id })
     res = cur.fetchone()
     video_path = res['video_path']
+    start, keyframe = seek_point(res, ms1)
 
-    return flask.Response(ff.make_gif(video_path, ms1, ms2), mimetype='image/gif')
+    path = materialize(media_key('gif', video_path, ms1, ms2), 'gif',
+                       lambda output: ff.gif_stream(video_path, start, ms2,
+                                                    output, keyframe=keyframe))
+    return send_media(path, 'image/gif')
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/gif/sub')
@@ -119,15 +298,19 @@ def gif_with_subtitles(season_id, episode_id, ms1, ms2):
 
     cur = get_db().cursor()
     cur.execute(
-        'SELECT video_path, subtitles_path FROM episode WHERE id=:episode_id',
+        'SELECT video_path, subtitles_path, fps, keyframes FROM episode '
+        ' WHERE id=:episode_id',
         { 'episode_id': episode_id })
     res = cur.fetchone()
     video_path = res['video_path']
     subtitles_path = res['subtitles_path']
+    start, keyframe = seek_point(res, ms1)
 
-    return flask.Response(
-        ff.make_gif_with_subtitles(video_path, subtitles_path, ms1, ms2),
-        mimetype='image/gif')
+    path = materialize(
+        media_key('gif_sub', video_path, subtitles_path, ms1, ms2), 'gif',
+        lambda output: ff.gif_with_subtitles_stream(
+            video_path, subtitles_path, start, ms2, output, keyframe=keyframe))
+    return send_media(path, 'image/gif')
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/webm')
@@ -139,12 +322,25 @@ def webm(season_id, episode_id, ms1, ms2):
         flask.abort(400, 'bad time range')
 
     cur = get_db().cursor()
-    cur.execute('SELECT video_path FROM episode WHERE id=:episode_id',
-                { 'episode_id': episode_id })
+    cur.execute(
+        'SELECT video_path, fps, height, codec, keyframes FROM episode '
+        ' WHERE id=:episode_id',
+        { 'episode_id': episode_id })
     res = cur.fetchone()
     video_path = res['video_path']
+    start, keyframe = seek_point(res, ms1)
 
-    return flask.Response(ff.make_webm(video_path, ms1, ms2), mimetype='video/webm')
+    # A VP8/VP9 source that is small enough can be cut without re-encoding,
+    # provided the clip starts on a keyframe.
+    copy = (keyframe and res['codec'] in ('vp8', 'vp9')
+            and res['height'] is not None
+            and res['height'] <= flask.current_app.config.get('WEBM_VRES'))
+
+    path = materialize(media_key('webm', video_path, ms1, ms2), 'webm',
+                       lambda output: ff.webm_stream(video_path, start, ms2,
+                                                     output, keyframe=keyframe,
+                                                     copy=copy))
+    return send_media(path, 'video/webm')
 
 
 @bp.route('/<season>/<episode>/<int:ms1>/<int:ms2>/webm/sub')
@@ -157,15 +353,32 @@ def webm_with_subtitles(season_id, episode_id, ms1, ms2):
 
     cur = get_db().cursor()
     cur.execute(
-        'SELECT video_path, subtitles_path FROM episode WHERE id=:episode_id',
+        'SELECT video_path, subtitles_path, fps, keyframes FROM episode '
+        ' WHERE id=:episode_id',
         { 'episode_id': episode_id })
     res = cur.fetchone()
     video_path = res['video_path']
     subtitles_path = res['subtitles_path']
+    start, keyframe = seek_point(res, ms1)
+
+    path = materialize(
+        media_key('webm_sub', video_path, subtitles_path, ms1, ms2), 'webm',
+        lambda output: ff.webm_with_subtitles_stream(
+            video_path, subtitles_path, start, ms2, output, keyframe=keyframe))
+    return send_media(path, 'video/webm')
 
-    return flask.Response(
-        ff.make_webm_with_subtitles(video_path, subtitles_path, ms1, ms2),
-        mimetype='video/webm')
+
+def seek_point(episode, ms):
+    # Snap to a keyframe less than half a frame away, if there is one, so that
+    # ffmpeg can seek straight to it instead of decoding up to the start.
+    keyframes = unpack_keyframes(episode['keyframes'])
+    if keyframes == [] or episode['fps'] is None:
+        return ms, False
+    tolerance = 500/episode['fps']
+    i = bisect_left(keyframes, ms - tolerance)
+    if i < len(keyframes) and abs(keyframes[i] - ms) <= tolerance:
+        return keyframes[i], True
+    return ms, False
 
 
 def check_range(episode_id, ms1, ms2, max_length):
@@ -182,6 +395,11 @@ def check_range(episode_id, ms1, ms2, max_length):
 
 def check_time(episode_id, ms):
     cur = get_db().cursor()
+    if lazy_snapshots():
+        # Any time within the episode will do.
+        cur.execute('SELECT duration FROM episode WHERE id=:episode_id',
+                    { 'episode_id': episode_id })
+        return ms >= 0 and ms <= cur.fetchone()['duration']
     cur.execute('SELECT ms FROM snapshot WHERE episode_id=:episode_id AND ms=:ms',
                 { 'episode_id': episode_id, 'ms': ms })
     return cur.fetchone() is not None
@@ -1,4 +1,7 @@
+import json
 import subprocess
+from fractions import Fraction
+from math import ceil
 
 import ffmpeg
 from flask import current_app
@@ -12,131 +15,162 @@ class FfprobeRuntimeError(Exception):
     pass
 
 
-def make_snapshot(video_path, time, vres=720):
-    stream = (ffmpeg
-              .input(video_path,
-                     ss=time)
-              .filter_('scale', -1, vres, flags='fast_bilinear')
-              .output('pipe:1',
-                      format='apng',
-                      vframes=1,
-                      q=1,
-                      threads=1))
-    return ffmpeg_run_stdout(stream)
-
-
-def make_snapshot_with_subtitles(video_path, subtitle_path, time,
-                                 fonts_path=None, font=None):
-    stream = ffmpeg.input(video_path,
-                          ss=time)
-    stream = ffmpeg_subtitles_filter(stream, subtitle_path, time,
-                                     fonts_path=fonts_path, font=font)
-    stream = ffmpeg.output(stream, 'pipe:1',
-                           format='singlejpeg',
-                           vframes=1,
-                           q=1,
-                           threads=1)
-    return ffmpeg_run_stdout(stream)
-
-
-def make_tiny_snapshot(video_path, time, vres=100):
-    stream = (ffmpeg
-              .input(video_path,
-                     ss=time)
-              .filter_('scale', -1, vres, flags='fast_bilinear')
-              .output('pipe:1',
-                      format='singlejpeg',
-                      vframes=1,
-                      q=5,
-                      threads=1))
-    return ffmpeg_run_stdout(stream)
-
-
-def make_gif(video_path, start_ms, end_ms):
-    start_s = str(start_ms/1000)
+def probe(video_path, ffprobe_path='ffprobe'):
+    # Read the video stream's metadata and the times of its keyframes, in ms,
+    # in one pass. Packets carry keyframe flags, so there is no need to decode
+    # anything.
+    try:
+        process = subprocess.run(
+            [ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+             '-show_streams', '-show_format',
+             '-show_entries', 'packet=pts_time,flags', '-of', 'json',
+             str(video_path)],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        raise FfprobeRuntimeError('could not probe %s: %s' % (video_path, e))
+    if process.returncode != 0:
+        raise FfprobeRuntimeError('could not probe %s: ffprobe exited with '
+                                  'status %d' % (video_path, process.returncode))
+    try:
+        info = json.loads(process.stdout.decode('utf-8'))
+    except ValueError as e:
+        raise FfprobeRuntimeError('could not probe %s: %s' % (video_path, e))
+    if info.get('streams', []) == []:
+        raise FfprobeRuntimeError('no video stream in %s' % video_path)
+    stream = info['streams'][0]
+    fmt = info.get('format', {})
+    duration = stream.get('duration', fmt.get('duration'))
+    if duration is None:
+        raise FfprobeRuntimeError('unknown duration for %s' % video_path)
+    start = float(fmt.get('start_time', 0))
+    try:
+        fps = float(Fraction(stream.get('avg_frame_rate', '')))
+    except (ValueError, ZeroDivisionError):
+        fps = None
+
+    keyframes = set()
+    for packet in info.get('packets', []):
+        pts_time = packet.get('pts_time', 'N/A')
+        if 'K' in packet.get('flags', '') and pts_time != 'N/A':
+            # Round up, so that seeking to the stored time never lands on
+            # the keyframe before.
+            keyframes.add(max(0, ceil((float(pts_time) - start)*1000)))
+
+    return { 'duration': round(float(duration)*1000),
+             'fps': fps,
+             'width': stream.get('width'),
+             'height': stream.get('height'),
+             'codec': stream.get('codec_name'),
+             'keyframes': sorted(keyframes) }
+
+
+def snapshot_stream(video_path, ms, vres, output, codec='png'):
+    # A single frame, seeked to accurately.
+    stream = seek_input(video_path, ms, False)
+    stream = ffmpeg.filter_(stream, 'scale', -1, vres)
+    return ffmpeg.output(stream, output,
+                         **{ 'format': 'image2',
+                             'c:v': codec,
+                             'frames:v': 1,
+                             'q:v': 2,
+                             'threads': 1 })
+
+
+def gif_stream(video_path, start_ms, end_ms, output, keyframe=False):
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
     vres=current_app.config.get('GIF_VRES')
 
     # Get color palette for the highest quality
-    pstream = ffmpeg.input(video_path, ss=start_s, t=duration)
+    pstream = seek_input(video_path, start_ms, keyframe, t=duration)
     pstream = ffmpeg.filter_(pstream, 'scale', -1, vres)
     pstream = ffmpeg.filter_(pstream, 'palettegen', stats_mode='full')
 
     # Create the actual jif
-    gstream = ffmpeg.input(video_path, ss=start_s)
+    gstream = seek_input(video_path, start_ms, keyframe)
     gstream = ffmpeg.filter_(gstream, 'scale', -1, vres)
     gstream = ffmpeg_paletteuse_filter(gstream, pstream,
                                        dither='bayer',
                                        bayer_scale=5,
                                        diff_mode='rectangle')
-    gstream = ffmpeg.output(gstream, 'pipe:1', format='gif', t=duration, threads=1)
-    return ffmpeg_run_stdout(gstream)
+    return ffmpeg.output(gstream, output, format='gif', t=duration, threads=1)
 
 
-def make_gif_with_subtitles(video_path, subtitle_path, start_ms, end_ms):
-    start_s = str(start_ms/1000)
+def gif_with_subtitles_stream(video_path, subtitle_path, start_ms, end_ms,
+                              output, keyframe=False):
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
     vres=current_app.config.get('GIF_VRES')
 
     # Get color palette for the highest quality
-    pstream = ffmpeg.input(video_path, ss=start_s, t=duration)
+    pstream = seek_input(video_path, start_ms, keyframe, t=duration)
     pstream = ffmpeg.filter_(pstream, 'scale', -1, vres)
     pstream = ffmpeg_subtitles_filter(pstream, subtitle_path, start_ms)
     pstream = ffmpeg.filter_(pstream, 'palettegen', stats_mode='full')
 
     # Create the actual jif
-    gstream = ffmpeg.input(video_path, ss=start_s)
+    gstream = seek_input(video_path, start_ms, keyframe)
     gstream = ffmpeg.filter_(gstream, 'scale', -1, vres)
     gstream = ffmpeg_subtitles_filter(gstream, subtitle_path, start_ms)
     gstream = ffmpeg_paletteuse_filter(gstream, pstream, dither='bayer',
                                        bayer_scale=5, diff_mode='rectangle')
-    gstream = ffmpeg.output(gstream, 'pipe:1', format='gif', t=duration, threads=1)
-    return ffmpeg_run_stdout(gstream)
+    return ffmpeg.output(gstream, output, format='gif', t=duration, threads=1)
 
 
-def make_webm(video_path, start_ms, end_ms):
-    start_s = str(start_ms/1000)
+def webm_stream(video_path, start_ms, end_ms, output, keyframe=False,
+                copy=False):
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
     vres=current_app.config.get('WEBM_VRES')
 
-    stream = ffmpeg.input(video_path, ss=start_s)
+    stream = seek_input(video_path, start_ms, keyframe)
+    if copy:
+        # The source is already suitable, so just cut out the packets.
+        return ffmpeg.output(stream, output,
+                             **{ 'format': 'webm',
+                                 't': duration,
+                                 'an': None,
+                                 'sn': None,
+                                 'c:v': 'copy' })
     stream = ffmpeg.filter_(stream, 'scale', -1, vres)
-    stream = ffmpeg.output(stream, 'pipe:1',
-                           **{ 'format': 'webm',
-                               't': duration,
-                               'an': None,
-                               'sn': None,
-                               'c:v': 'libvpx-vp9',
-                               'crf': 35,
-                               'b:v': '1000k',
-                               'cpu-used': 2,
-                               'threads': 1 })
-    return ffmpeg_run_stdout(stream)
-
-
-def make_webm_with_subtitles(video_path, subtitle_path, start_ms, end_ms):
-    start_s = str(start_ms/1000)
+    return ffmpeg.output(stream, output,
+                         **{ 'format': 'webm',
+                             't': duration,
+                             'an': None,
+                             'sn': None,
+                             'c:v': 'libvpx-vp9',
+                             'crf': 35,
+                             'b:v': '1000k',
+                             'cpu-used': 2,
+                             'threads': 1 })
+
+
+def webm_with_subtitles_stream(video_path, subtitle_path, start_ms, end_ms,
+                               output, keyframe=False):
     end_s = str(end_ms/1000)
     duration = str((end_ms - start_ms)/1000)
     vres=current_app.config.get('WEBM_VRES')
 
-    stream = ffmpeg.input(video_path, ss=start_s)
+    stream = seek_input(video_path, start_ms, keyframe)
     stream = ffmpeg.filter_(stream, 'scale', -1, vres)
     stream = ffmpeg_subtitles_filter(stream, subtitle_path, start_ms)
-    stream = ffmpeg.output(stream, 'pipe:1',
-                           **{ 'format': 'webm',
-                               't': duration,
-                               'an': None,
-                               'sn': None,
-                               'c:v': 'libvpx-vp9',
-                               'crf': 35,
-                               'b:v': '1000k',
-                               'cpu-used': 2,
-                               'threads': 1 })
-    return ffmpeg_run_stdout(stream)
+    return ffmpeg.output(stream, output,
+                         **{ 'format': 'webm',
+                             't': duration,
+                             'an': None,
+                             'sn': None,
+                             'c:v': 'libvpx-vp9',
+                             'crf': 35,
+                             'b:v': '1000k',
+                             'cpu-used': 2,
+                             'threads': 1 })
+
+
+def seek_input(video_path, start_ms, keyframe, **kwargs):
+    # Starting on a keyframe, there is nothing to decode and throw away.
+    if keyframe:
+        kwargs['noaccurate_seek'] = None
+    return ffmpeg.input(video_path, ss=str(start_ms/1000), **kwargs)
 
 
 def ffmpeg_subtitles_filter(stream, subtitle_path, start_ms):
@@ -162,17 +196,23 @@ def ffmpeg_paletteuse_filter(video_stream, palette_stream, **kwargs):
     return node.stream()
 
 
-def ffmpeg_run_stdout(stream):
+def ffmpeg_args(stream):
     # NOTE: nasty workaround for bad escaping by ffmpeg-python
     args = [str(a)
             .replace('\\\\\\\\\\\\\\', '\\\\\\')
             .replace('\\\\\\\\\\\\', '\\\\\\')
             for a in stream.get_args()]
-    args = [current_app.config.get('FFMPEG_PATH')] + args
+    return [current_app.config.get('FFMPEG_PATH')] + args
+
+
+def ffmpeg_run(args):
+    # Run to completion, for commands that write to a file.
     if not current_app.config.get('DEV'):
-        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        process = subprocess.run(args, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
     else:
         print('\nRunning: %s\n' % ' '.join(args))
-        process = subprocess.Popen(args, stdout=subprocess.PIPE)
-    return process.stdout
-
+        process = subprocess.run(args, stdout=subprocess.DEVNULL)
+    if process.returncode != 0:
+        raise FfmpegRuntimeError('ffmpeg exited with status %d'
+                                 % process.returncode)
@@ -0,0 +1,78 @@
+import numpy
+
+
+# Split hashes into this many chunks for the multi-index; any frame within
+# MULTI_INDEX_CHUNKS - 1 bits of the query shares at least one chunk with it.
+MULTI_INDEX_CHUNKS = 4
+
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], numpy.uint8)
+
+
+def hamming(hashes, value):
+    xor = numpy.bitwise_xor(hashes, numpy.uint64(value))
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(xor)
+    return POPCOUNT[xor.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class FrameIndex(object):
+
+    def __init__(self, episode_ids, ms, hashes, multi_index=False):
+        self.episode_ids = episode_ids
+        self.ms = ms
+        self.hashes = hashes
+        if multi_index:
+            bits = 64//MULTI_INDEX_CHUNKS
+            self._chunks = []
+            for i in range(MULTI_INDEX_CHUNKS):
+                keys = (hashes >> numpy.uint64(i*bits)) & numpy.uint64(2**bits - 1)
+                order = numpy.argsort(keys, kind='stable')
+                self._chunks.append((keys[order], order))
+        else:
+            self._chunks = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def nearest(self, value, n):
+        value = numpy.int64(value).view(numpy.uint64)
+        candidates = self._candidates(value)
+        if candidates is not None:
+            distances = hamming(self.hashes[candidates], value)
+            best = self._best(distances, n)
+            # Frames outside the candidates are at least MULTI_INDEX_CHUNKS
+            # bits away, so the result is only exact if the candidates
+            # already hold n frames closer than that.
+            if (len(best) < n
+                    or distances[best[-1]] >= MULTI_INDEX_CHUNKS):
+                candidates = None
+        if candidates is None:
+            candidates = numpy.arange(len(self.hashes))
+            distances = hamming(self.hashes, value)
+            best = self._best(distances, n)
+        return [(int(self.episode_ids[candidates[i]]),
+                 int(self.ms[candidates[i]]),
+                 int(distances[i]))
+                for i in best]
+
+    def _best(self, distances, n):
+        n = min(n, len(distances))
+        if n == 0:
+            return numpy.array([], numpy.intp)
+        best = numpy.argpartition(distances, n - 1)[:n]
+        return best[numpy.argsort(distances[best], kind='stable')]
+
+    def _candidates(self, value):
+        # Collect frames that share a chunk with the query; fall back to a
+        # full scan if there aren't any.
+        if self._chunks is None:
+            return None
+        bits = 64//MULTI_INDEX_CHUNKS
+        found = []
+        for i, (keys, order) in enumerate(self._chunks):
+            key = (value >> numpy.uint64(i*bits)) & numpy.uint64(2**bits - 1)
+            lo = numpy.searchsorted(keys, key, side='left')
+            hi = numpy.searchsorted(keys, key, side='right')
+            found.append(order[lo:hi])
+        found = numpy.unique(numpy.concatenate(found))
+        return found if len(found) > 0 else None
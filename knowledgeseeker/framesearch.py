@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+import flask
+from PIL import Image, UnidentifiedImageError
+
+from knowledgeseeker.database import get_db, get_generation, get_shows
+from knowledgeseeker.utils import dhash
+
+
+bp = flask.Blueprint('framesearch', __name__)
+
+N_RESULTS = 10
+MAX_RESULTS = 50
+MAX_PIXELS = 4096*4096
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_index():
+    generation = get_generation()
+    with _lock:
+        index = _indexes.get(generation)
+        if index is not None:
+            _indexes.move_to_end(generation)
+            return index
+
+        # Only load numpy once someone actually searches.
+        import numpy
+        from knowledgeseeker.frameindex import FrameIndex
+
+        cur = get_db().cursor()
+        cur.execute('SELECT episode_id, ms, dhash FROM frame_hash')
+        rows = cur.fetchall()
+        index = FrameIndex(
+            numpy.array([row['episode_id'] for row in rows], numpy.int32),
+            numpy.array([row['ms'] for row in rows], numpy.int64),
+            numpy.array([row['dhash'] for row in rows], numpy.int64)
+                .view(numpy.uint64),
+            multi_index=flask.current_app.config.get('FRAME_SEARCH_MULTI_INDEX',
+                                                     False))
+        if generation is not None:
+            # One per show, plus one while a show's new build takes over.
+            _indexes[generation] = index
+            while len(_indexes) > len(get_shows()) + 1:
+                _indexes.popitem(last=False)
+        return index
+
+
+@bp.route('/framesearch', methods=['POST'])
+def search():
+    upload = flask.request.files.get('image')
+    if upload is None:
+        flask.abort(400, 'no image uploaded')
+    try:
+        # Opening only reads the header; check the size before decoding.
+        image = Image.open(upload.stream)
+        if image.width*image.height > flask.current_app.config.get(
+                'FRAME_SEARCH_MAX_PIXELS', MAX_PIXELS):
+            flask.abort(400, 'image too large')
+        value = dhash(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError,
+            OSError, ValueError, SyntaxError):
+        flask.abort(400, 'unreadable image')
+    n = max(1, min(flask.request.args.get('n', N_RESULTS, type=int),
+                   MAX_RESULTS))
+
+    matches = get_index().nearest(value, n=n)
+    cur = get_db().cursor()
+    cur.execute('PRAGMA full_column_names = ON')
+    cur.execute(
+        '    SELECT episode.id, episode.slug, season.slug FROM episode '
+        'INNER JOIN season ON season.id = episode.season_id')
+    slugs = { row['episode.id']: (row['season.slug'], row['episode.slug'])
+              for row in cur.fetchall() }
+    cur.execute('PRAGMA full_column_names = OFF')
+
+    results = []
+    for episode_id, ms, distance in matches:
+        season, episode = slugs[episode_id]
+        slug_kwargs = { 'season': season, 'episode': episode, 'ms': ms }
+        results.append({
+            'season': season,
+            'episode': episode,
+            'ms': ms,
+            'distance': distance,
+            'url': flask.url_for('webui.browse_moment', **slug_kwargs),
+            'tiny': flask.url_for('clips.snapshot_tiny', **slug_kwargs) })
+    return flask.jsonify(results=results)
@@ -0,0 +1,402 @@
+import io
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy
+from flask import current_app
+from PIL import Image
+
+import knowledgeseeker.database as database
+import knowledgeseeker.ffmpeg as ff
+from knowledgeseeker.utils import dhash, pack_keyframes, strip_html
+
+
+POPULATE_WORKERS = int(os.environ.get('POPULATE_WORKERS', os.cpu_count()))
+RENDITION_QUALITY = { 'webp': 80, 'avif': 60 }
+SPRITE_SHEET_SIZE = 100
+SPRITE_COLUMNS = 10
+
+
+def populate(library_data, path, include=None):
+    # Season and episode ids follow the order of the library file, so they
+    # agree between databases built from the same library.
+    db = database.create(path)
+    cur = db.cursor()
+    season_key = episode_key = 0
+    episodes = {}
+    for season in library_data:
+        cur.execute(
+            'INSERT INTO season (id, slug, icon_png, name) '
+            '       VALUES (:id, :slug, :icon_png, :name)',
+            { 'id': season_key,
+              'slug': season.slug,
+              'icon_png': season.icon,
+              'name': season.name })
+        for episode in season.episodes:
+            if include is not None and not include(episode_key, season, episode):
+                episode_key += 1
+                continue
+            cur.execute(
+                'INSERT INTO episode (id, slug, name, duration, '
+                '                     video_path, subtitles_path, season_id) '
+                '       VALUES (:id, :slug, :name, :duration, '
+                '               :video_path, :subtitles_path, :season_id)',
+                { 'id': episode_key,
+                  'slug': episode.slug,
+                  'name': episode.name,
+                  'duration': 0,
+                  'video_path': str(episode.video_path),
+                  'subtitles_path': str(episode.subtitles_path),
+                  'season_id': season_key })
+            episodes[episode_key] = episode
+            episode_key += 1
+        season_key += 1
+    db.commit()
+
+    lazy = current_app.config.get('LAZY_SNAPSHOTS', False)
+    database.set_meta(cur, 'lazy_snapshots', '1' if lazy else '0')
+    db.commit()
+    config = { 'full_vres': current_app.config['JPEG_VRES'],
+               'tiny_vres': current_app.config['JPEG_TINY_VRES'],
+               'formats': supported_formats(
+                   current_app.config.get('SNAPSHOT_FORMATS', [])),
+               'dedupe_ssim': current_app.config.get('DEDUPE_SSIM', None),
+               'lazy': lazy }
+    ffprobe_path = current_app.config.get('FFPROBE_PATH', 'ffprobe')
+    def fill(key):
+        cursor = db.cursor()
+        episode = episodes[key]
+        saved, frames, dropped, stored = populate_episode(
+            episode, key, cursor, **config)
+        populate_metadata(episode, key, cursor, ffprobe_path)
+        populate_subtitles(episode, key, cursor)
+        if not lazy:
+            populate_sprites(key, cursor)
+        res = ('%s - %d/%d frames (%.1f%%) saved'
+               % (episode.name, saved, frames, saved/frames*100.0))
+        if dropped > 0:
+            res += ', %d near-duplicates dropped' % dropped
+        if dropped > 0 and stored > 0:
+            res += ' (~%.1f MiB)' % (dropped*stored/saved/2**20)
+        return res
+    with ThreadPoolExecutor(max_workers=POPULATE_WORKERS) as executor:
+        for res in executor.map(fill, episodes.keys()):
+            print(' * %s' % res)
+    database.new_generation(cur)
+    db.commit()
+    db.close()
+
+
+def supported_formats(formats):
+    Image.init()
+    supported = []
+    for fmt in formats:
+        if fmt.upper() in Image.SAVE:
+            supported.append(fmt)
+        else:
+            print(' * Pillow cannot write %s, skipping those renditions' % fmt)
+    return supported
+
+
+def populate_episode(episode, key, cur, full_vres=720, tiny_vres=100,
+                     formats=[], dedupe_ssim=None, lazy=False):
+    # Locate and save significant frames.
+    vidcap = cv2.VideoCapture(str(episode.video_path))
+    frames = saved = dropped = stored = ms = 0
+    classifier = FrameClassifier()
+    deduplicator = FrameDeduplicator(dedupe_ssim, subtitles=episode.subtitles)
+    success, image = vidcap.read()
+    while success:
+        ms = round(vidcap.get(cv2.CAP_PROP_POS_MSEC))
+        keep = classifier.classify(image, ms)
+        if keep and not deduplicator.keep(image, ms):
+            keep = False
+            dropped += 1
+        if keep:
+            classifier.saved(image, ms)
+        if keep and lazy:
+            saved += 1
+
+            # Keep just the time, and the hash for reverse screenshot search.
+            cur.execute(
+                'INSERT OR IGNORE INTO snapshot (episode_id, ms, png) '
+                '       VALUES (:episode_id, :ms, NULL)',
+                { 'episode_id': key, 'ms': ms })
+            tiny_scale = tiny_vres/image.shape[0]
+            tiny_image = cv2.resize(
+                image,
+                (round(image.shape[1]*tiny_scale), round(image.shape[0]*tiny_scale)),
+                interpolation=cv2.INTER_AREA)
+            cur.execute(
+                'INSERT OR IGNORE INTO frame_hash (episode_id, ms, dhash) '
+                '       VALUES (:episode_id, :ms, :dhash)',
+                { 'episode_id': key, 'ms': ms,
+                  'dhash': dhash(Image.fromarray(
+                      cv2.cvtColor(tiny_image, cv2.COLOR_BGR2RGB))) })
+        elif keep:
+            saved += 1
+
+            big_scale = full_vres/image.shape[0]
+            big_image = cv2.resize(
+                image,
+                (round(image.shape[1]*big_scale), round(image.shape[0]*big_scale)),
+                interpolation=cv2.INTER_AREA)
+            big_png = cv2.imencode('.png', big_image)[1].tobytes()
+            cur.execute(
+                'INSERT OR IGNORE INTO snapshot (episode_id, ms, png) '
+                '       VALUES (:episode_id, :ms, :png)',
+                { 'episode_id': key, 'ms': ms, 'png': sqlite3.Binary(big_png) })
+
+            tiny_scale = tiny_vres/image.shape[0]
+            tiny_image = cv2.resize(
+                image,
+                (round(image.shape[1]*tiny_scale), round(image.shape[0]*tiny_scale)),
+                interpolation=cv2.INTER_AREA)
+            tiny_jpg = cv2.imencode('.jpg', tiny_image)[1].tobytes()
+            cur.execute(
+                'INSERT OR IGNORE INTO snapshot_tiny (episode_id, ms, jpeg) '
+                '       VALUES (:episode_id, :ms, :jpeg)',
+                { 'episode_id': key, 'ms': ms, 'jpeg': sqlite3.Binary(tiny_jpg) })
+            stored += len(big_png) + len(tiny_jpg)
+            cur.execute(
+                'INSERT OR IGNORE INTO frame_hash (episode_id, ms, dhash) '
+                '       VALUES (:episode_id, :ms, :dhash)',
+                { 'episode_id': key, 'ms': ms,
+                  'dhash': dhash(Image.fromarray(
+                      cv2.cvtColor(tiny_image, cv2.COLOR_BGR2RGB))) })
+
+            for size, sized_image in [('full', big_image), ('tiny', tiny_image)]:
+                for fmt, data in encode_renditions(sized_image, formats):
+                    stored += len(data)
+                    cur.execute(
+                        'INSERT OR IGNORE INTO snapshot_rendition '
+                        '            (episode_id, ms, size, format, data) '
+                        '     VALUES (:episode_id, :ms, :size, :format, :data)',
+                        { 'episode_id': key, 'ms': ms, 'size': size,
+                          'format': fmt, 'data': sqlite3.Binary(data) })
+        frames += 1
+        success, image = vidcap.read()
+
+    # Set the episode's duration.
+    cur.execute('UPDATE episode SET duration=:ms WHERE id=:id',
+                { 'id': key, 'ms': ms })
+
+    # Set the episode's preview frame.
+    cur.execute(
+        '  SELECT ms FROM snapshot '
+        '   WHERE episode_id=:episode_id '
+        'ORDER BY ABS(ms-:target) ASC LIMIT 1',
+        { 'episode_id': key, 'target': round(ms/2) })
+    res = cur.fetchone()
+    if res is not None:
+        cur.execute(
+            'UPDATE episode SET snapshot_ms=:snapshot_ms WHERE id=:id',
+            { 'id': key, 'snapshot_ms': res['ms'] })
+
+    return saved, frames, dropped, stored
+
+
+def populate_metadata(episode, key, cur, ffprobe_path):
+    # Replace the duration read from the last frame with the exact one.
+    try:
+        meta = ff.probe(episode.video_path, ffprobe_path=ffprobe_path)
+    except ff.FfprobeRuntimeError as e:
+        print(' * %s - %s' % (episode.name, e))
+        return
+    cur.execute(
+        'UPDATE episode SET duration=:duration, fps=:fps, width=:width, '
+        '                   height=:height, codec=:codec, keyframes=:keyframes '
+        ' WHERE id=:id',
+        { 'id': key,
+          'duration': meta['duration'],
+          'fps': meta['fps'],
+          'width': meta['width'],
+          'height': meta['height'],
+          'codec': meta['codec'],
+          'keyframes': sqlite3.Binary(pack_keyframes(meta['keyframes'])) })
+
+
+def encode_renditions(image, formats):
+    if formats == []:
+        return
+    pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    for fmt in formats:
+        res = io.BytesIO()
+        pil_image.save(res, fmt, quality=RENDITION_QUALITY.get(fmt, 75))
+        yield fmt, res.getvalue()
+
+
+class FrameClassifier(object):
+
+    TRANS_THRESHOLD = 90.0
+    TARGET_FPS = 5.0
+
+    def __init__(self):
+        self._last = self._saved = None
+
+    def classify(self, image, ms):
+        # - Save all hard transitions (color difference > TRANS_THRESHOLD).
+        # - Save at least 3 images per second, but only if there isn't a long
+        #   period of duplicate frames.
+        if self._last is None:
+            self._last = (image, ms)
+            save = True
+        else:
+            last_image, last_ms = self._last
+
+            last_color = numpy.average(last_image, axis=(0, 1))
+            this_color = numpy.average(image, axis=(0, 1))
+            color_diff = numpy.sum(abs(last_color - this_color))
+            if color_diff > FrameClassifier.TRANS_THRESHOLD:
+                #cv2.imwrite('classify_last.png', last_image)
+                #cv2.imwrite('classify_next.png', image)
+                #input('transition detected at %d' % ms)
+                save = True
+            elif ((self._saved is None
+                   or ms - self._saved[1] >= 1000/FrameClassifier.TARGET_FPS)
+                  and color_diff > 0.1):
+                save = True
+            else:
+                save = False
+        self._last = (image, ms)
+        return save
+
+    def saved(self, image, ms):
+        # Measure the gap to the next frame from the last one actually stored,
+        # not just picked.
+        self._saved = (image, ms)
+
+
+class FrameDeduplicator(object):
+
+    WIDTH = 128
+
+    def __init__(self, threshold, subtitles=[]):
+        # Drop frames whose structural similarity to the last kept frame is
+        # at least threshold, unless a subtitle line would be left without
+        # a frame.
+        self.threshold = threshold
+        self._kept = None
+        self._lines = sorted((sub.start.total_seconds()*1000,
+                              sub.end.total_seconds()*1000)
+                             for sub in subtitles)
+        self._next_line = 0
+        self._open_lines = []
+
+    def keep(self, image, ms):
+        if self.threshold is None:
+            return True
+
+        # Track the subtitle lines on screen that have no frame yet.
+        while (self._next_line < len(self._lines)
+               and self._lines[self._next_line][0] <= ms):
+            self._open_lines.append(self._lines[self._next_line])
+            self._next_line += 1
+        self._open_lines = [line for line in self._open_lines if line[1] >= ms]
+
+        scale = FrameDeduplicator.WIDTH/image.shape[1]
+        small = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),
+                           (FrameDeduplicator.WIDTH, round(image.shape[0]*scale)),
+                           interpolation=cv2.INTER_AREA).astype(numpy.float32)
+        if (self._kept is None or self._open_lines != []
+                or ssim(self._kept, small) < self.threshold):
+            self._kept = small
+            self._open_lines = []
+            return True
+        else:
+            return False
+
+
+def ssim(a, b):
+    c1 = (0.01*255)**2
+    c2 = (0.03*255)**2
+    def blur(x):
+        return cv2.GaussianBlur(x, (7, 7), 1.5)
+    mu_a = blur(a)
+    mu_b = blur(b)
+    var_a = blur(a*a) - mu_a*mu_a
+    var_b = blur(b*b) - mu_b*mu_b
+    cov = blur(a*b) - mu_a*mu_b
+    ssim_map = (((2*mu_a*mu_b + c1)*(2*cov + c2))
+                /((mu_a*mu_a + mu_b*mu_b + c1)*(var_a + var_b + c2)))
+    return float(ssim_map.mean())
+
+
+def populate_subtitles(episode, key, cur):
+    for sub in episode.subtitles:
+        start_ms = sub.start.total_seconds()*1000
+        end_ms = sub.end.total_seconds()*1000
+        cur.execute(
+            'SELECT ms FROM snapshot '
+            '       WHERE episode_id=:episode_id '
+            '             AND ms>=:start_ms AND ms<=:end_ms '
+            'ORDER BY ms',
+            { 'episode_id': key, 'start_ms': start_ms, 'end_ms': end_ms })
+        snapshot_ms = next(map(lambda row: row['ms'], cur.fetchall()), None)
+        cur.execute(
+            'INSERT INTO subtitle (episode_id, idx, content, '
+            '                      start_ms, end_ms, snapshot_ms) '
+            '       VALUES (:episode_id, :idx, :content, '
+            '               :start_ms, :end_ms, :snapshot_ms)',
+            { 'episode_id': key, 'content': sub.content, 'idx': sub.index,
+              'start_ms': start_ms, 'end_ms': end_ms, 'snapshot_ms': snapshot_ms })
+        if snapshot_ms is not None:
+            cur.execute(
+                'INSERT INTO subtitle_search (episode_id, snapshot_ms, content) '
+                '       VALUES (:episode_id, :snapshot_ms, :content)',
+                { 'episode_id': key, 'snapshot_ms': snapshot_ms,
+                  'content': strip_html(sub.content) })
+
+
+def populate_sprites(key, cur):
+    # Pack the thumbnails shown on the episode page into a few sheets.
+    cur.execute(
+        '  SELECT ms, jpeg FROM snapshot_tiny '
+        '   WHERE episode_id=:episode_id '
+        '         AND ms IN (SELECT snapshot_ms FROM subtitle '
+        '                     WHERE episode_id=:episode_id) '
+        'ORDER BY ms',
+        { 'episode_id': key })
+    frames = []
+    for row in cur.fetchall():
+        image = cv2.imdecode(numpy.frombuffer(row['jpeg'], numpy.uint8),
+                             cv2.IMREAD_COLOR)
+        if image is None:
+            # The episode page falls back to the thumbnail itself.
+            print(' * episode %d: unreadable thumbnail at %d ms, '
+                  'leaving it out of the sprites' % (key, row['ms']))
+            continue
+        frames.append((row['ms'], image))
+    for start in range(0, len(frames), SPRITE_SHEET_SIZE):
+        sheet_idx = start//SPRITE_SHEET_SIZE
+        chunk = frames[start:start + SPRITE_SHEET_SIZE]
+        images = [image for _, image in chunk]
+        cell_w = max(image.shape[1] for image in images)
+        cell_h = max(image.shape[0] for image in images)
+        columns = min(len(images), SPRITE_COLUMNS)
+        lines = (len(images) + columns - 1)//columns
+        sheet = numpy.zeros((lines*cell_h, columns*cell_w, 3), numpy.uint8)
+        tiles = []
+        for i, (ms, image) in enumerate(chunk):
+            height, width = image.shape[:2]
+            x = i%columns*cell_w
+            y = i//columns*cell_h
+            sheet[y:y + height, x:x + width] = image
+            tiles.append({ 'episode_id': key, 'ms': ms,
+                           'sheet_idx': sheet_idx, 'x': x, 'y': y,
+                           'width': width, 'height': height })
+
+        sheet_jpg = cv2.imencode('.jpg', sheet)[1].tobytes()
+        cur.execute(
+            'INSERT INTO sprite_sheet (episode_id, idx, jpeg) '
+            '       VALUES (:episode_id, :idx, :jpeg)',
+            { 'episode_id': key, 'idx': sheet_idx,
+              'jpeg': sqlite3.Binary(sheet_jpg) })
+        cur.executemany(
+            'INSERT INTO sprite (episode_id, ms, sheet_idx, '
+            '                    x, y, width, height) '
+            '       VALUES (:episode_id, :ms, :sheet_idx, '
+            '               :x, :y, :width, :height)',
+            tiles)
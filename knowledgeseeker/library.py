@@ -1,13 +1,15 @@
 import json
+import os
+import re
+import sqlite3
+from functools import wraps
 from pathlib import Path
 
 import click
-from flask import current_app
+from flask import current_app, g
 from flask.cli import with_appcontext
-from srt import parse as parse_srt
 
 import knowledgeseeker.database as database
-import knowledgeseeker.ffmpeg as ff
 
 
 class LoadError(Exception):
@@ -35,6 +37,7 @@ class Episode(object):
         if subtitles_path is None:
             self.subtitles = []
         else:
+            from srt import parse as parse_srt
             with open(subtitles_path) as f:
                 self.subtitles = list(parse_srt(f.read()))
                 self.subtitles.sort(key=lambda s: s.index)
@@ -73,19 +76,124 @@ def read_episode_json(episode_data, relative_to=Path('.')):
     return Episode(slug, video_path, subtitles_path=subtitles_path, name=name)
 
 
+def get_library_path():
+    show = database.get_show()
+    if show is None:
+        return Path(current_app.config.get('LIBRARY'))
+    return Path(current_app.config['LIBRARIES'][show]['LIBRARY'])
+
+
 def init_app(app):
     app.cli.add_command(read_library_command)
+    app.cli.add_command(merge_library_command)
+
+
+def show_option(f):
+    # Commands act on one show's library and database when LIBRARIES is set.
+    @click.option('--show', default=None,
+                  help='Show to work on, one of the keys of LIBRARIES.')
+    @wraps(f)
+    def decorator(show, **kwargs):
+        shows = database.get_shows()
+        if shows != [] and show not in shows:
+            raise click.BadParameter('expected one of: %s' % ', '.join(shows),
+                                     param_hint='--show')
+        elif shows == [] and show is not None:
+            raise click.BadParameter('LIBRARIES is not configured',
+                                     param_hint='--show')
+        g.show = show
+        return f(**kwargs)
+    return decorator
+
+
+def parse_shard(value):
+    match = re.search(r'^(\d+)/(\d+)$', value)
+    if match is None:
+        raise click.BadParameter('expected K/N, e.g. 3/8', param_hint='--shard')
+    k, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= k <= n:
+        raise click.BadParameter('need 1 <= K <= N', param_hint='--shard')
+    return k, n
 
 
 @click.command('read-library')
+@click.option('--shard', default=None,
+              help='Only read every Nth episode, starting with the Kth (K/N).')
+@click.option('--episodes', default=None,
+              help='Only read these comma-separated season/episode slugs.')
+@click.option('--output', default=None,
+              help='Database to write, relative to the instance folder.')
 @with_appcontext
-def read_library_command():
-    database.remove()
-    db = database.get_db()
-    with current_app.open_resource('schema.sql', mode='r') as f:
-        db.cursor().executescript(f.read())
-    db.commit()
-
-    library_data = load_library_file(Path(current_app.config.get('LIBRARY')))
-    database.populate(library_data)
-
+@show_option
+def read_library_command(shard, episodes, output):
+    if shard is not None and episodes is not None:
+        raise click.UsageError('--shard and --episodes cannot be combined')
+
+    library_data = load_library_file(get_library_path())
+
+    include = None
+    if shard is not None:
+        k, n = parse_shard(shard)
+        include = lambda key, season, episode: key%n == k - 1
+        if output is None:
+            output = 'data-shard%dof%d.db' % (k, n)
+    elif episodes is not None:
+        wanted = set(slug.strip() for slug in episodes.split(','))
+        known = set('%s/%s' % (season.slug, episode.slug)
+                    for season in library_data for episode in season.episodes)
+        if not wanted <= known:
+            raise click.BadParameter(
+                'not in library: %s' % ', '.join(sorted(wanted - known)),
+                param_hint='--episodes')
+        include = lambda key, season, episode: (
+            '%s/%s' % (season.slug, episode.slug) in wanted)
+        if output is None:
+            output = 'data-partial.db'
+
+    # Ingest needs OpenCV, which web workers can do without.
+    import knowledgeseeker.ingest as ingest
+    if output is not None:
+        ingest.populate(library_data, Path(current_app.instance_path)/output,
+                        include=include)
+        return
+
+    # Build next to the live database, then swap it in, so the app keeps
+    # serving the old one in the meantime.
+    path = database.get_path()
+    building = path.with_name(path.name + '.building')
+    try:
+        ingest.populate(library_data, building, include=include)
+    except BaseException:
+        remove_partial(building)
+        raise
+    os.replace(building, path)
+
+
+@click.command('merge-library')
+@click.argument('shards', nargs=-1, required=True)
+@with_appcontext
+@show_option
+def merge_library_command(shards):
+    paths = [Path(current_app.instance_path)/shard for shard in shards]
+    for path in paths:
+        if not path.exists():
+            raise click.BadParameter('%s does not exist' % path)
+
+    # Build next to the live database, then swap it in.
+    path = database.get_path()
+    building = path.with_name(path.name + '.merging')
+    try:
+        database.merge(paths, building)
+    except BaseException as e:
+        remove_partial(building)
+        if isinstance(e, sqlite3.IntegrityError):
+            raise click.ClickException('cannot merge shards: %s' % e)
+        raise
+    os.replace(building, path)
+    print(' * merged %d shards into %s' % (len(paths), path))
+
+
+def remove_partial(path):
+    # Leave nothing half-built next to the live database.
+    for leftover in [path, path.with_name(path.name + '-journal')]:
+        leftover.unlink(missing_ok=True)
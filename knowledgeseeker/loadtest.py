@@ -0,0 +1,383 @@
+import io
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+import ffmpeg
+from flask import current_app
+from PIL import Image, ImageDraw
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import knowledgeseeker.database as database
+import knowledgeseeker.ffmpeg as ff
+from knowledgeseeker.utils import dhash
+
+
+ROUTES = ['tiny', 'batch', 'pic', 'moment', 'moment_json', 'episode', 'search',
+          'gif', 'webm', 'viral']
+# A steady share of requests for one clip stands in for a link going viral.
+DEFAULT_MIX = ('tiny=40,batch=5,pic=10,moment=15,moment_json=5,episode=5,'
+               'search=10,gif=2,webm=2,viral=6')
+TRANSCODE_ROUTES = ['gif', 'webm', 'viral']
+ACCEPT = 'image/avif,image/webp,*/*'
+BATCH_SIZE = 20
+
+SYNTHETIC_SEASONS = 2
+SYNTHETIC_EPISODES = 3
+SYNTHETIC_SECONDS = 120
+SYNTHETIC_STEP_MS = 500
+SYNTHETIC_IMAGES = 24
+WORDS = ['avatar', 'zuko', 'appa', 'honor', 'fire', 'water', 'earth', 'air',
+         'katara', 'sokka', 'aang', 'iroh', 'tea', 'nation', 'spirit', 'moon',
+         'ocean', 'boomerang', 'momo', 'uncle']
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Traffic(object):
+    # Picks URLs for each kind of request from what is in the database.
+
+    def __init__(self, path, rng, prefix=''):
+        db = sqlite3.connect(str(path))
+        db.row_factory = sqlite3.Row
+        cur = db.cursor()
+        cur.execute('PRAGMA full_column_names = ON')
+        cur.execute(
+            '    SELECT episode.id, episode.slug, season.slug FROM episode '
+            'INNER JOIN season ON season.id = episode.season_id')
+        slugs = { row['episode.id']: (row['season.slug'], row['episode.slug'])
+                  for row in cur.fetchall() }
+        cur.execute('PRAGMA full_column_names = OFF')
+        cur.execute('SELECT episode_id, ms FROM snapshot ORDER BY episode_id, ms')
+        self.moments = [slugs[row['episode_id']] + (row['ms'],)
+                        for row in cur.fetchall()]
+        cur.execute('SELECT content FROM subtitle_search LIMIT 1000')
+        self.words = sorted(set(word.strip('.,!?"').lower()
+                                for row in cur.fetchall()
+                                for word in row['content'].split()
+                                if len(word) > 3)) or WORDS
+        db.close()
+        if self.moments == []:
+            raise click.ClickException('the database has no snapshots')
+        self.rng = rng
+        self.prefix = prefix
+        self.viral = self._clip('gif')
+        self.routes = { 'tiny': self.tiny, 'batch': self.batch, 'pic': self.pic,
+                        'moment': self.moment, 'moment_json': self.moment_json,
+                        'episode': self.episode, 'search': self.search,
+                        'gif': lambda: self._clip('gif'),
+                        'webm': lambda: self._clip('webm'),
+                        'viral': lambda: self.viral }
+
+    def url(self, route):
+        return self.prefix + self.routes[route]()
+
+    def tiny(self):
+        return '/%s/%s/%d/pic/tiny' % self.rng.choice(self.moments)
+
+    def batch(self):
+        return '/pic/tiny?%s' % '&'.join(
+            'f=%s/%s/%d' % moment
+            for moment in self.rng.sample(self.moments,
+                                          min(BATCH_SIZE, len(self.moments))))
+
+    def pic(self):
+        return '/%s/%s/%d/pic' % self.rng.choice(self.moments)
+
+    def moment(self):
+        return '/%s/%s/%d/' % self.rng.choice(self.moments)
+
+    def moment_json(self):
+        return '/%s/%s/%d/moment.json' % self.rng.choice(self.moments)
+
+    def episode(self):
+        return '/%s/%s/' % self.rng.choice(self.moments)[:2]
+
+    def search(self):
+        return '/search?q=%s' % self.rng.choice(self.words)
+
+    def _clip(self, kind):
+        # A few seconds between two snapshots of the same episode.
+        i = self.rng.randrange(len(self.moments))
+        season, episode, ms1 = self.moments[i]
+        ms2 = ms1
+        for other_season, other_episode, ms in self.moments[i + 1:i + 20]:
+            if (other_season, other_episode) != (season, episode):
+                break
+            if ms - ms1 > 3000:
+                break
+            ms2 = ms
+        if ms2 == ms1:
+            return '/%s/%s/%d/pic' % (season, episode, ms1)
+        return '/%s/%s/%d/%d/%s' % (season, episode, ms1, ms2, kind)
+
+
+def run(app, traffic, mix, rate, seconds, concurrency):
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+
+    def fetch(route, url, due):
+        request = urllib.request.Request(base + url, headers={ 'Accept': ACCEPT })
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 0
+        # Measure from when the request was due, so a backlog counts.
+        return route, status, time.perf_counter() - due
+
+    routes = list(mix.keys())
+    weights = list(mix.values())
+    sampler = FfmpegSampler(Path(app.config.get('FFMPEG_PATH', 'ffmpeg')).name)
+    sampler.start()
+    futures = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(round(rate*seconds)):
+            due = start + i/rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route = traffic.rng.choices(routes, weights)[0]
+            futures.append(executor.submit(fetch, route, traffic.url(route), due))
+    results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+    server.shutdown()
+    return results, elapsed, sampler.peak
+
+
+class FfmpegSampler(object):
+    # Polls /proc for ffmpeg processes started by this one.
+
+    INTERVAL = 0.02
+
+    def __init__(self, name):
+        self.name = name[:15]
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def start(self):
+        if not os.path.isdir('/proc'):
+            print(' * warning: no /proc on this system, '
+                  'ffmpeg processes will not be counted')
+            self.peak = None
+            return
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _poll(self):
+        pid = str(os.getpid())
+        while not self._stop.wait(FfmpegSampler.INTERVAL):
+            count = 0
+            for entry in os.scandir('/proc'):
+                if not entry.name.isdigit():
+                    continue
+                try:
+                    with open(os.path.join(entry.path, 'stat'), 'rt') as f:
+                        stat = f.read()
+                except OSError:
+                    continue
+                # The name is in parentheses and may contain spaces.
+                name = stat[stat.index('(') + 1:stat.rindex(')')]
+                ppid = stat[stat.rindex(')') + 2:].split()[1]
+                if name == self.name and ppid == pid:
+                    count += 1
+            self.peak = max(self.peak, count)
+
+
+def make_synthetic(path, directory):
+    # A small library of generated images and subtitles, plus a test pattern
+    # video for transcodes if ffmpeg can make one. Returns whether it could.
+    rng = random.Random(0)
+    vres = current_app.config.get('JPEG_VRES', 720)
+    tiny_vres = current_app.config.get('JPEG_TINY_VRES', 100)
+    size = (round(vres*16/9), vres)
+    images = []
+    for i in range(SYNTHETIC_IMAGES):
+        image = Image.linear_gradient('L').resize(size).convert('RGB')
+        image = Image.blend(image, Image.new('RGB', size, (rng.randrange(256),
+                                                           rng.randrange(256),
+                                                           rng.randrange(256))),
+                            0.5)
+        draw = ImageDraw.Draw(image)
+        for _ in range(8):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            draw.ellipse((x, y, x + rng.randrange(50, 300), y + rng.randrange(50, 300)),
+                         fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        noise = Image.effect_noise(size, 20).convert('RGB')
+        image = Image.blend(image, noise, 0.1)
+        png = io.BytesIO()
+        image.save(png, 'png')
+        tiny = image.resize((round(size[0]*tiny_vres/size[1]), tiny_vres))
+        jpeg = io.BytesIO()
+        tiny.save(jpeg, 'jpeg')
+        images.append((png.getvalue(), jpeg.getvalue(), dhash(tiny)))
+
+    video_path = directory/'synthetic.avi'
+    try:
+        ff.ffmpeg_run(ff.ffmpeg_args(
+            ffmpeg.input('testsrc2=duration=%d:size=%dx%d:rate=12'
+                         % (SYNTHETIC_SECONDS, size[0], size[1]), f='lavfi')
+                  .output(str(video_path), **{ 'c:v': 'mjpeg', 'q:v': 5 })))
+        has_video = True
+    except (ff.FfmpegRuntimeError, OSError):
+        has_video = False
+
+    db = database.create(path)
+    cur = db.cursor()
+    episode_key = 0
+    for season_key in range(SYNTHETIC_SEASONS):
+        cur.execute(
+            'INSERT INTO season (id, slug, icon_png, name) '
+            '       VALUES (:id, :slug, NULL, :name)',
+            { 'id': season_key, 'slug': 's%d' % (season_key + 1),
+              'name': 'Season %d' % (season_key + 1) })
+        for i in range(SYNTHETIC_EPISODES):
+            duration = SYNTHETIC_SECONDS*1000
+            cur.execute(
+                'INSERT INTO episode (id, slug, name, duration, snapshot_ms, '
+                '                     video_path, subtitles_path, season_id) '
+                '       VALUES (:id, :slug, :name, :duration, :snapshot_ms, '
+                '               :video_path, NULL, :season_id)',
+                { 'id': episode_key, 'slug': 'e%d' % (i + 1),
+                  'name': 'Episode %d' % (i + 1), 'duration': duration,
+                  'snapshot_ms': duration//2, 'video_path': str(video_path),
+                  'season_id': season_key })
+            for ms in range(0, duration, SYNTHETIC_STEP_MS):
+                png, jpeg, value = images[rng.randrange(len(images))]
+                key = { 'episode_id': episode_key, 'ms': ms }
+                cur.execute(
+                    'INSERT INTO snapshot (episode_id, ms, png) '
+                    '       VALUES (:episode_id, :ms, :png)',
+                    dict(key, png=png))
+                cur.execute(
+                    'INSERT INTO snapshot_tiny (episode_id, ms, jpeg) '
+                    '       VALUES (:episode_id, :ms, :jpeg)',
+                    dict(key, jpeg=jpeg))
+                cur.execute(
+                    'INSERT INTO frame_hash (episode_id, ms, dhash) '
+                    '       VALUES (:episode_id, :ms, :dhash)',
+                    dict(key, dhash=value))
+            for idx, start_ms in enumerate(range(0, duration - 2000, 2000)):
+                content = ' '.join(rng.choice(WORDS) for _ in range(6))
+                cur.execute(
+                    'INSERT INTO subtitle (episode_id, idx, content, '
+                    '                      start_ms, end_ms, snapshot_ms) '
+                    '       VALUES (:episode_id, :idx, :content, '
+                    '               :start_ms, :end_ms, :start_ms)',
+                    { 'episode_id': episode_key, 'idx': idx + 1,
+                      'content': content, 'start_ms': start_ms,
+                      'end_ms': start_ms + 1500 })
+                cur.execute(
+                    'INSERT INTO subtitle_search (episode_id, snapshot_ms, content) '
+                    '       VALUES (:episode_id, :snapshot_ms, :content)',
+                    { 'episode_id': episode_key, 'snapshot_ms': start_ms,
+                      'content': content })
+            episode_key += 1
+    database.new_generation(cur)
+    db.commit()
+    db.close()
+    return has_video
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise click.BadParameter('unknown route: %s' % route, param_hint='--mix')
+        try:
+            mix[route] = float(weight)
+        except ValueError:
+            raise click.BadParameter('expected route=weight, e.g. tiny=40',
+                                     param_hint='--mix')
+    return mix
+
+
+def percentile(values, fraction):
+    if values == []:
+        return 0
+    return values[min(len(values) - 1, int(len(values)*fraction))]
+
+
+def report(results, elapsed, peak_ffmpeg):
+    errors = sum(1 for _, status, _ in results if status == 0 or status >= 500)
+    print(' * %d requests in %.1f s: %.1f req/s, %.1f%% errors, '
+          'peak %s ffmpeg processes'
+          % (len(results), elapsed, len(results)/elapsed,
+             errors/max(1, len(results))*100,
+             'unknown' if peak_ffmpeg is None else peak_ffmpeg))
+    print('   %-12s %7s %7s %9s %9s %9s'
+          % ('route', 'count', 'errors', 'p50', 'p95', 'p99'))
+    for route in sorted(set(route for route, _, _ in results)):
+        latencies = sorted(latency for r, _, latency in results if r == route)
+        route_errors = sum(1 for r, status, _ in results
+                           if r == route and (status == 0 or status >= 500))
+        print('   %-12s %7d %7d %7.1fms %7.1fms %7.1fms'
+              % (route, len(latencies), route_errors,
+                 percentile(latencies, 0.5)*1000,
+                 percentile(latencies, 0.95)*1000,
+                 percentile(latencies, 0.99)*1000))
+
+
+def load_test(synthetic, rate, duration, concurrency, mix, seed):
+    from knowledgeseeker import create_app
+
+    mix = parse_mix(mix)
+    # Serve a fresh app, configured like this one.
+    config = dict(current_app.config)
+    directory = None
+    prefix = ''
+    try:
+        if synthetic:
+            directory = Path(tempfile.mkdtemp(prefix='loadtest-',
+                                              dir=current_app.instance_path))
+            path = directory/database.FILENAME
+            print(' * building a synthetic library in %s' % directory)
+            if not make_synthetic(path, directory):
+                print(' * ffmpeg could not make a test video, '
+                      'leaving out transcodes')
+                for route in TRANSCODE_ROUTES:
+                    mix.pop(route, None)
+            config.update({ 'DATABASE': str(path), 'LIBRARIES': None,
+                            'PAGE_CACHE_DISK': False })
+        else:
+            path = database.get_path()
+            if not path.exists():
+                raise click.ClickException(
+                    'no library found, run read-library or use --synthetic')
+            if database.get_show() is not None:
+                prefix = '/%s' % database.get_show()
+        app = create_app(config)
+
+        traffic = Traffic(path, random.Random(seed), prefix=prefix)
+        print(' * sending %.0f req/s for %.0f s, at most %d at once'
+              % (rate, duration, concurrency))
+        report(*run(app, traffic, mix, rate, duration, concurrency))
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
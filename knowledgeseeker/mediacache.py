@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from hashlib import sha1
+from pathlib import Path
+from uuid import uuid4
+
+from flask import current_app, request, send_file
+
+import knowledgeseeker.ffmpeg as ff
+
+
+DIRECTORY = 'media'
+# Set in the WSGI environ by servers that run ffmpeg themselves.
+DEFER_ENVIRON_KEY = 'knowledgeseeker.defer_ffmpeg'
+# Never prune files used this recently; they may be about to be sent.
+PRUNE_GRACE = 60
+
+# Build locks by path, with the number of threads holding or waiting on each.
+_building = {}
+_lock = threading.Lock()
+
+
+class DeferredRun(Exception):
+    # Raised instead of running ffmpeg when the server runs it itself. The
+    # server must run args, then call finish() if ffmpeg succeeded or
+    # cleanup() if it did not, and then dispatch the request again.
+    def __init__(self, key, args, finish, cleanup):
+        super().__init__(key)
+        self.key = key
+        self.args = args
+        self.finish = finish
+        self.cleanup = cleanup
+
+
+def materialize(key, extension, make_stream):
+    # Render a file once with ffmpeg and keep it for later requests, so that
+    # it can be sent with a length and in ranges.
+    directory = Path(current_app.instance_path)/DIRECTORY
+    digest = sha1(repr(key).encode('utf-8')).hexdigest()
+    path = directory/('%s.%s' % (digest, extension))
+    if touch(path):
+        return path
+
+    with _lock:
+        entry = _building.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if touch(path):
+                return path
+            directory.mkdir(parents=True, exist_ok=True)
+            part = path.with_name('%s.%s.part' % (path.name, uuid4().hex))
+            args = ff.ffmpeg_args(make_stream(str(part)))
+
+            def finish():
+                os.replace(part, path)
+                prune(directory, keep=path)
+            def cleanup():
+                if part.exists():
+                    part.unlink()
+
+            if request.environ.get(DEFER_ENVIRON_KEY, False):
+                raise DeferredRun(str(path), args, finish, cleanup)
+            try:
+                ff.ffmpeg_run(args)
+            except Exception:
+                cleanup()
+                raise
+            finish()
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _building[path]
+    return path
+
+
+def send_media(path, mimetype):
+    # The name is a digest of everything the file was made from, so it is a
+    # stable validator; mtime stays put since only atime tracks use.
+    expires = current_app.config.get('HTTP_CACHE_EXPIRES')
+    return send_file(path, mimetype=mimetype, conditional=True,
+                     etag=path.stem, last_modified=path.stat().st_mtime,
+                     max_age=int(expires.total_seconds()))
+
+
+def touch(path):
+    # Mark a cached file as recently used, leaving mtime alone for
+    # Last-Modified.
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def prune(directory, keep=None):
+    limit = current_app.config.get('MEDIA_CACHE_SIZE', None)
+    if limit is None:
+        return
+    entries = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith('.part'):
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    recent = time.time() - PRUNE_GRACE
+    for atime, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if atime >= recent or path == str(keep):
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,182 @@
+import shutil
+import threading
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
+from pathlib import Path
+
+import click
+from flask import current_app, request, url_for
+from flask.cli import with_appcontext
+
+from knowledgeseeker.database import get_db, get_generation, get_show
+from knowledgeseeker.library import show_option
+
+
+DIRECTORY = 'pages'
+
+_pages = OrderedDict()
+_lock = threading.Lock()
+
+
+def cached_page(f):
+    # Rendered pages are a pure function of the database, the code and config
+    # that render them, and the URL, so key them by all three and skip the view
+    # entirely on a hit.
+    @wraps(f)
+    def decorator(**kwargs):
+        build = build_key()
+        if build is None:
+            return f(**kwargs)
+        key = (build, page_digest(request.script_root + request.path))
+        with _lock:
+            page = _pages.get(key)
+            if page is not None:
+                _pages.move_to_end(key)
+                return page
+
+        page = read_disk(*key)
+        if page is None:
+            page = f(**kwargs)
+        remember(key, page)
+        return page
+    return decorator
+
+
+def remember(key, page):
+    size = current_app.config.get('PAGE_CACHE_SIZE', 0)
+    if size <= 0:
+        return
+    with _lock:
+        _pages[key] = page
+        _pages.move_to_end(key)
+        while len(_pages) > size:
+            _pages.popitem(last=False)
+
+
+def page_digest(path):
+    return sha1(path.encode('utf-8')).hexdigest()
+
+
+def build_key():
+    generation = get_generation()
+    if generation is None:
+        return None
+    return '%s-%s' % (generation, fingerprint())
+
+
+def fingerprint():
+    # Hash the package's code and templates along with the config, computed
+    # once per app.
+    app = current_app._get_current_object()
+    value = app.extensions.get('pagecache')
+    if value is None:
+        hasher = sha1()
+        package = Path(__file__).parent
+        paths = list(package.glob('*.py')) + list((package/'templates').rglob('*'))
+        for path in sorted(paths):
+            if path.is_file():
+                hasher.update(path.relative_to(package).as_posix().encode('utf-8'))
+                hasher.update(path.read_bytes())
+        hasher.update(repr(sorted((key, repr(value))
+                                  for key, value in app.config.items()))
+                      .encode('utf-8'))
+        value = app.extensions['pagecache'] = hasher.hexdigest()[:16]
+    return value
+
+
+def pages_directory():
+    # Shows are built separately, so each keeps its own pages.
+    directory = Path(current_app.instance_path)/DIRECTORY
+    show = get_show()
+    return directory if show is None else directory/show
+
+
+def disk_path(build, digest):
+    return pages_directory()/build/('%s.html' % digest)
+
+
+def read_disk(build, digest):
+    if not current_app.config.get('PAGE_CACHE_DISK', False):
+        return None
+    try:
+        with open(disk_path(build, digest), 'rt', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def warm_up():
+    # Load pre-rendered pages into memory.
+    build = build_key()
+    if build is None or not current_app.config.get('PAGE_CACHE_DISK', False):
+        return
+    directory = pages_directory()/build
+    if not directory.exists():
+        return
+    size = current_app.config.get('PAGE_CACHE_SIZE', 0)
+    for path in sorted(directory.glob('*.html'))[:size]:
+        page = read_disk(build, path.stem)
+        if page is not None:
+            remember((build, path.stem), page)
+
+
+def init_app(app):
+    app.cli.add_command(render_pages_command)
+
+
+@click.command('render-pages')
+@click.option('--script-name', default=None,
+              help='Path the app is served under, if not the root of the site. '
+                   'Defaults to APPLICATION_ROOT.')
+@with_appcontext
+@show_option
+def render_pages_command(script_name):
+    build = build_key()
+    if build is None:
+        raise click.ClickException('no library found, run read-library first')
+    if script_name is None:
+        script_name = current_app.config.get('APPLICATION_ROOT') or '/'
+    script_name = '/' + script_name.strip('/')
+    if script_name == '/':
+        script_name = ''
+
+    cur = get_db().cursor()
+    cur.execute('PRAGMA full_column_names = ON')
+    cur.execute(
+        '    SELECT season.slug, episode.slug FROM season '
+        'LEFT JOIN episode ON episode.season_id = season.id')
+    rows = cur.fetchall()
+    cur.execute('PRAGMA full_column_names = OFF')
+    # Paths relative to the app; pages are requested and keyed under the
+    # script name, so that their links point where the server's do.
+    with current_app.test_request_context(base_url='http://localhost/'):
+        urls = set()
+        for row in rows:
+            urls.add(url_for('webui.browse_season', season=row['season.slug']))
+            if row['episode.slug'] is not None:
+                urls.add(url_for('webui.browse_episode',
+                                 season=row['season.slug'],
+                                 episode=row['episode.slug']))
+
+    # Pages from previous builds can never be hit again.
+    directory = pages_directory()
+    if directory.exists():
+        for old in directory.iterdir():
+            if old.name != build:
+                shutil.rmtree(old, ignore_errors=True)
+
+    client = current_app.test_client()
+    rendered = 0
+    for url in sorted(urls):
+        response = client.get(url, base_url='http://localhost%s/' % script_name)
+        if response.status_code != 200:
+            print(' * %s - skipped (%d)' % (script_name + url,
+                                             response.status_code))
+            continue
+        path = disk_path(build, page_digest(script_name + url))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(response.get_data())
+        rendered += 1
+    print(' * %d pages rendered to %s' % (rendered, directory/build))
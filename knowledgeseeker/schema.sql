@@ -11,6 +11,11 @@ CREATE TABLE episode (
     slug           TEXT    NOT NULL,
     name           TEXT,
     duration       INTEGER NOT NULL,
+    fps            REAL,
+    width          INTEGER,
+    height         INTEGER,
+    codec          TEXT,
+    keyframes      BLOB,
     snapshot_ms    INTEGER,
     video_path     TEXT,
     subtitles_path TEXT,
@@ -20,7 +25,7 @@ CREATE TABLE episode (
 CREATE TABLE snapshot (
     episode_id INTEGER NOT NULL,
     ms         INTEGER NOT NULL,
-    png        BLOB    NOT NULL,
+    png        BLOB,
                PRIMARY KEY (episode_id, ms)
                FOREIGN KEY (episode_id) REFERENCES episode(id)
                CHECK(ms >= 0)
@@ -33,6 +38,42 @@ CREATE TABLE snapshot_tiny (
                FOREIGN KEY (episode_id) REFERENCES episode(id)
                CHECK(ms >= 0)
 );
+CREATE TABLE snapshot_rendition (
+    episode_id INTEGER NOT NULL,
+    ms         INTEGER NOT NULL,
+    size       TEXT    NOT NULL,
+    format     TEXT    NOT NULL,
+    data       BLOB    NOT NULL,
+               PRIMARY KEY (episode_id, ms, size, format)
+               FOREIGN KEY (episode_id) REFERENCES episode(id)
+               CHECK(ms >= 0)
+);
+CREATE TABLE frame_hash (
+    episode_id INTEGER NOT NULL,
+    ms         INTEGER NOT NULL,
+    dhash      INTEGER NOT NULL,
+               PRIMARY KEY (episode_id, ms)
+               FOREIGN KEY (episode_id) REFERENCES episode(id)
+               CHECK(ms >= 0)
+);
+CREATE TABLE sprite_sheet (
+    episode_id INTEGER NOT NULL,
+    idx        INTEGER NOT NULL,
+    jpeg       BLOB    NOT NULL,
+               PRIMARY KEY (episode_id, idx)
+               FOREIGN KEY (episode_id) REFERENCES episode(id)
+);
+CREATE TABLE sprite (
+    episode_id INTEGER NOT NULL,
+    ms         INTEGER NOT NULL,
+    sheet_idx  INTEGER NOT NULL,
+    x          INTEGER NOT NULL,
+    y          INTEGER NOT NULL,
+    width      INTEGER NOT NULL,
+    height     INTEGER NOT NULL,
+               PRIMARY KEY (episode_id, ms)
+               FOREIGN KEY (episode_id, sheet_idx) REFERENCES sprite_sheet(episode_id, idx)
+);
 CREATE TABLE subtitle (
     episode_id  INTEGER NOT NULL,
     idx         INTEGER,
@@ -50,3 +91,7 @@ CREATE TABLE subtitle (
 CREATE VIRTUAL TABLE subtitle_search
        USING fts5(episode_id UNINDEXED, snapshot_ms UNINDEXED, content,
                   tokenize = 'porter ascii');
+CREATE TABLE meta (
+    key   TEXT PRIMARY KEY,
+    value
+);
@@ -0,0 +1,108 @@
+import sqlite3
+
+import flask
+
+from knowledgeseeker.database import get_path, get_shows
+from knowledgeseeker.webui import N_SEARCH_RESULTS, clean_query
+
+
+bp = flask.Blueprint('shows', __name__)
+
+
+def url_prefix(app):
+    # With LIBRARIES set, every per-show route lives under its show's key.
+    libraries = app.config.get('LIBRARIES')
+    if not libraries:
+        return None
+    return '/<any(%s):show>' % ', '.join("'%s'" % show for show in libraries)
+
+
+def show_name(show):
+    return flask.current_app.config['LIBRARIES'][show].get('NAME', show)
+
+
+@bp.route('/')
+def index():
+    shows = [{ 'slug': show, 'name': show_name(show) } for show in get_shows()]
+    return flask.render_template('shows.html', shows=shows)
+
+
+@bp.route('/search')
+def search():
+    query = clean_query(flask.request.args.get('q'))
+    if query == '':
+        return flask.render_template('shows_search.html', query='')
+
+    # Each show has its own FTS index; take the best from each and merge them
+    # by rank. bm25 scores are only roughly comparable between indexes, but
+    # close enough to interleave shows sensibly.
+    results = []
+    for show in get_shows():
+        for row in search_show(show, query):
+            slug_kwargs = { 'show': show,
+                            'season': row['season.slug'],
+                            'episode': row['episode.slug'],
+                            'ms': row['search.snapshot_ms'] }
+            results.append({
+                'show': show_name(show),
+                'content': row['search.content'],
+                'rank': row['search.rank'],
+                'url': flask.url_for('webui.browse_moment', **slug_kwargs),
+                'tiny': flask.url_for('clips.snapshot_tiny', **slug_kwargs) })
+    results.sort(key=lambda result: result['rank'])
+    results = results[:N_SEARCH_RESULTS]
+    return flask.render_template('shows_search.html', query=query,
+                                 results=results, n_results=len(results))
+
+
+def search_show(show, query):
+    # A show whose database is missing or being migrated is left out rather
+    # than failing the whole search.
+    path = get_path(show)
+    try:
+        db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    except sqlite3.OperationalError:
+        return []
+    db.row_factory = sqlite3.Row
+    try:
+        cur = db.cursor()
+        cur.execute('PRAGMA full_column_names = ON')
+        cur.execute(
+            '    SELECT episode.slug, season.slug, search.snapshot_ms, '
+            '           search.content, search.rank '
+            '           FROM season '
+            'INNER JOIN episode ON episode.season_id = season.id '
+            'INNER JOIN (SELECT episode_id, snapshot_ms, content, rank '
+            '              FROM subtitle_search '
+            '             WHERE content MATCH :query '
+            '          ORDER BY rank LIMIT :n_results) search '
+            '           ON search.episode_id = episode.id',
+            { 'query': ' '.join('"%s"' % term for term in query.split()),
+              'n_results': N_SEARCH_RESULTS })
+        return cur.fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        db.close()
+
+
+def init_app(app):
+    if not app.config.get('LIBRARIES'):
+        return
+    app.register_blueprint(bp)
+
+    @app.url_value_preprocessor
+    def pull_show(endpoint, values):
+        if values is not None and 'show' in values:
+            flask.g.show = values.pop('show')
+            # Don't let sqlite create an empty database for a show that has
+            # not been read yet.
+            if not get_path().exists():
+                flask.abort(404, 'show not found')
+
+    @app.url_defaults
+    def add_show(endpoint, values):
+        show = flask.g.get('show')
+        if (show is not None and values.get('show') is None
+                and app.url_map.is_endpoint_expecting(endpoint, 'show')):
+            values['show'] = show
@@ -0,0 +1,49 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+# Runs in a fresh interpreter, like a newly spawned web worker.
+PROBE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+from knowledgeseeker import create_app
+app = create_app(%r)
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds': elapsed,
+    'maxrss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': sorted(name for name in ['cv2', 'numpy', 'srt']
+                      if name in sys.modules) }))
+'''
+
+
+def measure(runs=5, preload=False):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE % { 'PRELOAD': preload }],
+            check=True, stdout=subprocess.PIPE).stdout
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    return { 'seconds': statistics.median(r['seconds'] for r in results),
+             'maxrss_kib': statistics.median(r['maxrss_kib'] for r in results),
+             'modules': results[-1]['modules'] }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure worker cold-start time and memory.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--preload', action='store_true',
+                        help='also warm up the database and caches')
+    args = parser.parse_args()
+    res = measure(runs=args.runs, preload=args.preload)
+    print('create_app: %.0f ms, max RSS %.1f MiB, heavy modules loaded: %s'
+          % (res['seconds']*1000, res['maxrss_kib']/1024,
+             ', '.join(res['modules']) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
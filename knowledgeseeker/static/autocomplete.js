@@ -0,0 +1,73 @@
+/* Suggest search terms and preview matching moments while typing */
+Autocomplete = {
+        delay: 100,
+        url: document.currentScript.dataset.url,
+
+        timer: null,
+        controller: null,
+        /* responses already seen, by query */
+        cache: {}
+};
+
+Autocomplete.init = function() {
+        var inputs = document.querySelectorAll("input[data-autocomplete]");
+        Array.prototype.forEach.call(inputs, function(input) {
+                input.addEventListener("input", function(e) {
+                        clearTimeout(Autocomplete.timer);
+                        Autocomplete.timer = setTimeout(function() {
+                                Autocomplete.update(input);
+                        }, Autocomplete.delay);
+                });
+        });
+};
+
+Autocomplete.update = function(input) {
+        var query = input.value;
+        if (Autocomplete.cache[query] !== undefined) {
+                Autocomplete.show(input, Autocomplete.cache[query]);
+                return;
+        }
+
+        if (Autocomplete.controller !== null)
+                Autocomplete.controller.abort();
+        Autocomplete.controller = new AbortController();
+        fetch(Autocomplete.url + "?q=" + encodeURIComponent(query),
+              { signal: Autocomplete.controller.signal })
+                .then(function(response) {
+                        if (!response.ok)
+                                throw new Error(response.statusText);
+                        return response.json();
+                })
+                .then(function(data) {
+                        Autocomplete.cache[query] = data;
+                        Autocomplete.show(input, data);
+                })
+                .catch(function() {});
+};
+
+Autocomplete.show = function(input, data) {
+        var list = document.getElementById(input.getAttribute("list"));
+        list.innerHTML = "";
+        data.terms.forEach(function(term) {
+                var option = document.createElement("option");
+                option.value = term;
+                list.appendChild(option);
+        });
+
+        var preview = document.getElementById(input.dataset.autocomplete);
+        if (preview === null)
+                return;
+        preview.innerHTML = "";
+        data.moments.forEach(function(moment) {
+                var image = document.createElement("img");
+                image.src = moment.tiny;
+                image.alt = "";
+                var link = document.createElement("a");
+                link.href = moment.url;
+                link.title = moment.content.replace(/<\/?[^>]+>/g, "");
+                link.appendChild(image);
+                preview.appendChild(link);
+        });
+};
+
+Autocomplete.init();
@@ -9,6 +9,15 @@ Moment = {
         request: null,
         currentUrl: null,
 
+        /* moments fetched from the server, by ms */
+        moments: {},
+        fetching: {},
+        prefetched: {},
+        currentMs: null,
+        titleSuffix: null,
+        prefetchAhead: 2,
+        prefetchBehind: 1,
+
         text: {
                 processing: "processing (this can take awhile)",
                 permalink: "Permalink:",
@@ -24,6 +33,41 @@ Moment.init = function() {
                 Moment.openMedia(this.href);
         });
 
+        /* jump to wherever the scrubber is let go */
+        var scrubber = $("form.scrubber");
+        var scrubberRange = scrubber.find("input[type=\"range\"]");
+        scrubberRange.on("input", function(e) {
+                var ms = Math.round(this.value*1000/$(this).data("fps"));
+                scrubber.find("output").text(Moment.timecode(ms));
+        });
+        scrubberRange.on("change", function(e) {
+                scrubber.submit();
+        });
+
+        /* step through moments without reloading the page */
+        var browser = $("#browser");
+        if (browser.length > 0 && window.history.pushState) {
+                Moment.currentMs = browser.data("ms");
+                Moment.titleSuffix = browser.data("title-suffix");
+                Moment.fetchMoments(browser.data("moment-json"));
+
+                browser.on("click", "a[data-ms]", function(e) {
+                        var ms = $(this).data("ms");
+                        if (Moment.moments[ms] !== undefined) {
+                                e.preventDefault();
+                                Moment.showMoment(ms, true);
+                        }
+                });
+                window.history.replaceState({ ms: Moment.currentMs }, "");
+                $(window).on("popstate", function(e) {
+                        var state = e.originalEvent.state;
+                        if (state !== null && Moment.moments[state.ms] !== undefined)
+                                Moment.showMoment(state.ms, false);
+                        else
+                                window.location.reload();
+                });
+        }
+
         /* shade that covers the rest of the page */
         Moment.dialogShade = $("<div>");
         Moment.dialogShade.attr("class", "media-dialog-shade");
@@ -58,6 +102,111 @@ Moment.init = function() {
         Moment.dialog.append(Moment.displayScreen);
 };
 
+Moment.fetchMoments = function(url) {
+        if (Moment.fetching[url])
+                return;
+        Moment.fetching[url] = true;
+        $.getJSON(url, function(data) {
+                data.moments.forEach(function(moment) {
+                        Moment.moments[moment.ms] = moment;
+                });
+                Moment.prefetch();
+        }).always(function() {
+                delete Moment.fetching[url];
+        });
+};
+
+Moment.showMoment = function(ms, push) {
+        var moment = Moment.moments[ms];
+        Moment.currentMs = ms;
+
+        $(".preview-image > img").attr("src", moment.snapshot);
+        $("a.media-link.snapshot").attr("href", moment.snapshot);
+        $("a.media-link.snapshot-sub").attr("href", moment.snapshot_sub);
+        var scrubberRange = $("form.scrubber input[type=\"range\"]");
+        scrubberRange.val(Math.round(ms*scrubberRange.data("fps")/1000));
+        $("form.scrubber output").text(Moment.timecode(ms));
+
+        var subtitleList = $(".subtitle-list");
+        subtitleList.empty();
+        moment.subtitles.forEach(function(subtitle) {
+                var line = $("<span>");
+                line.attr("class", "subtitle");
+                if (subtitle.now) {
+                        line.addClass("now");
+                        line.html(subtitle.content);
+                } else if (subtitle.url !== null) {
+                        var link = $("<a>");
+                        link.attr({ href: subtitle.url, "data-ms": subtitle.ms });
+                        link.html(subtitle.content);
+                        line.append(link);
+                } else {
+                        line.html(subtitle.content);
+                }
+                subtitleList.append(line, " ");
+        });
+
+        var navBrowser = $(".nav-browser");
+        navBrowser.empty();
+        moment.nav.forEach(function(nav) {
+                var image = $("<img>");
+                image.attr("src", Thumbnails.urls[nav.tiny] || nav.tiny);
+
+                var item;
+                if (nav.ms === ms) {
+                        item = $("<span>");
+                        item.attr("class", "nav-moment now");
+                        image.attr("alt", "right now");
+                        item.append(image);
+                } else {
+                        var past = nav.ms < ms,
+                            offset = Math.abs(ms - nav.ms);
+                        item = $("<a>");
+                        item.attr({ "class": "nav-moment " + (past ? "past" : "future"),
+                                    href: nav.url,
+                                    "data-ms": nav.ms });
+                        image.attr("alt", offset + "s " + (past ? "behind" : "ahead"));
+
+                        var fill = $("<span>");
+                        fill.attr("class", "fill");
+                        var value = $("<span>");
+                        value.attr("class", "value");
+                        value.text((past ? "-" : "+") + offset + "ms");
+                        var offsetLabel = $("<span>");
+                        offsetLabel.attr("class", "offset");
+                        offsetLabel.append(fill, value);
+                        item.append(image, offsetLabel);
+                }
+                navBrowser.append(item, " ");
+        });
+
+        document.title = (moment.current_line === "" ? "" :
+                          "\"" + moment.current_line + "\" - ") + Moment.titleSuffix;
+        if (push)
+                window.history.pushState({ ms: ms }, "", moment.url);
+
+        /* keep the moments around this one at hand */
+        if (moment.nav.some(function(nav) { return Moment.moments[nav.ms] === undefined; }))
+                Moment.fetchMoments(moment.json);
+        Moment.prefetch();
+};
+
+/* have the browser fetch the images of the next few moments */
+Moment.prefetch = function() {
+        var moment = Moment.moments[Moment.currentMs];
+        if (moment === undefined)
+                return;
+        var i = moment.nav.findIndex(function(nav) { return nav.ms === moment.ms; });
+        moment.nav.slice(Math.max(0, i - Moment.prefetchBehind), i + 1 + Moment.prefetchAhead)
+                .forEach(function(nav) {
+                        var next = Moment.moments[nav.ms];
+                        if (next !== undefined && !Moment.prefetched[next.snapshot]) {
+                                Moment.prefetched[next.snapshot] = true;
+                                (new Image()).src = next.snapshot;
+                        }
+                });
+};
+
 Moment.openMedia = function(url) {
         Moment._show(Moment.dialogShade);
         Moment._show(Moment.dialogWrapper);
@@ -91,6 +240,8 @@ Moment.displayMedia = function(blob) {
          * hope the browser cached it */
         switch (blob.type) {
         case "image/jpeg":
+        case "image/webp":
+        case "image/avif":
         case "image/gif":
                 image = $("<img>");
                 image.attr({ "src": Moment.currentUrl,
@@ -132,6 +283,12 @@ Moment.displayMedia = function(blob) {
         case "image/jpeg":
                 filename = "snapshot.jpg";
                 break;
+        case "image/webp":
+                filename = "snapshot.webp";
+                break;
+        case "image/avif":
+                filename = "snapshot.avif";
+                break;
         case "image/gif":
                 filename = "animation.gif";
                 break;
@@ -162,6 +319,18 @@ Moment.dismissMedia = function() {
                 Moment.request.abort();
 };
 
+Moment.timecode = function(ms) {
+        var s = Math.floor(ms/1000);
+        var minutes = Math.floor(s/60) % 60,
+            seconds = s % 60;
+        var code = (seconds < 10 ? "0" : "") + seconds;
+        if (s >= 3600)
+                return Math.floor(s/3600) + ":" + (minutes < 10 ? "0" : "") +
+                        minutes + ":" + code;
+        else
+                return minutes + ":" + code;
+};
+
 Moment._show = function(element) {
         element.css("display", "block");
 };
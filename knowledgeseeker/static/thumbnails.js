@@ -0,0 +1,88 @@
+/* Fetch every thumbnail marked with data-frame in a few batch requests
+ * instead of one request each */
+Thumbnails = {
+        batchSize: 50,
+        batchUrl: document.currentScript.dataset.batchUrl,
+
+        /* object URLs of loaded thumbnails, by their own URL */
+        urls: {},
+
+        /* fetch() accepts any type, which the server takes as JPEG only,
+         * so name the formats this browser can decode; 1x1 samples of each */
+        accept: "image/jpeg",
+        formats: {
+                "image/webp": "data:image/webp;base64," +
+                        "UklGRiQAAABXRUJQVlA4IBgAAAAwAQCdASoBAAEAAUAmJaQAA3AA/vz0AAA=",
+                "image/avif": "data:image/avif;base64," +
+                        "AAAAIGZ0eXBhdmlmAAAAAGF2aWZtaWYxbWlhZk1BMUIAAADrbWV0YQAAAAAAAAAh" +
+                        "aGRscgAAAAAAAAAAcGljdAAAAAAAAAAAAAAAAAAAAAAOcGl0bQAAAAAAAQAAAB5p" +
+                        "bG9jAAAAAEQAAAEAAQAAAAEAAAETAAAAJQAAAChpaW5mAAAAAAABAAAAGmluZmUC" +
+                        "AAAAAAEAAGF2MDFDb2xvcgAAAABqaXBycAAAAEtpcGNvAAAAFGlzcGUAAAAAAAAA" +
+                        "AQAAAAEAAAAQcGl4aQAAAAADCAgIAAAADGF2MUOBAAwAAAAAE2NvbHJuY2x4AAEA" +
+                        "DQAGgAAAABdpcG1hAAAAAAAAAAEAAQQBAoMEAAAALW1kYXQSAAoIGAAGiAhoNCAy" +
+                        "FxTHh4ZlAgggnlAAAAD2b2M9SPG6ZHSs"
+        }
+};
+
+Thumbnails.init = function() {
+        var images = Array.prototype.slice.call(
+                document.querySelectorAll("img[data-frame]"));
+        if (images.length === 0)
+                return;
+        Thumbnails.detectFormats().then(function() {
+                for (var i = 0; i < images.length; i += Thumbnails.batchSize)
+                        Thumbnails.load(images.slice(i, i + Thumbnails.batchSize));
+        });
+};
+
+Thumbnails.detectFormats = function() {
+        var types = Object.keys(Thumbnails.formats);
+        return Promise.all(types.map(function(type) {
+                return new Promise(function(resolve) {
+                        var image = new Image();
+                        image.onload = function() { resolve(image.width > 0); };
+                        image.onerror = function() { resolve(false); };
+                        image.src = Thumbnails.formats[type];
+                });
+        })).then(function(supported) {
+                Thumbnails.accept = types.filter(function(type, i) {
+                        return supported[i];
+                }).concat(["image/jpeg"]).join(",");
+        });
+};
+
+Thumbnails.load = function(images) {
+        var query = images.map(function(image) {
+                return "f=" + encodeURIComponent(image.dataset.frame);
+        });
+        fetch(Thumbnails.batchUrl + "?" + query.join("&"),
+              { headers: { Accept: Thumbnails.accept } })
+                .then(function(response) {
+                        if (!response.ok)
+                                throw new Error(response.statusText);
+                        var offsets = response.headers.get("X-Offsets")
+                                .split(",").map(Number);
+                        var types = response.headers.get("X-Types").split(",");
+                        return response.arrayBuffer().then(function(buffer) {
+                                images.forEach(function(image, i) {
+                                        var end = i + 1 < offsets.length ?
+                                                offsets[i + 1] : buffer.byteLength;
+                                        if (end > offsets[i]) {
+                                                image.src = URL.createObjectURL(new Blob(
+                                                        [buffer.slice(offsets[i], end)],
+                                                        { type: types[i] }));
+                                                Thumbnails.urls[image.dataset.src] = image.src;
+                                        } else
+                                                Thumbnails.fallback(image);
+                                });
+                        });
+                })
+                .catch(function() { images.forEach(Thumbnails.fallback); });
+};
+
+/* load the image on its own */
+Thumbnails.fallback = function(image) {
+        image.src = image.dataset.src;
+};
+
+Thumbnails.init();
@@ -1,9 +1,11 @@
 import re
+import struct
 from datetime import datetime, timedelta
 from functools import wraps
 from time import mktime
 
 from flask import current_app
+from PIL import Image
 from wsgiref.handlers import format_date_time
 
 
@@ -46,3 +48,26 @@ def set_expires(f):
 def strip_html(s):
     return re.sub(r'</?[^>]+>', '', s)
 
+
+def dhash(image):
+    # 64-bit difference hash: compare each pixel of a 9x8 grayscale thumbnail
+    # with its right-hand neighbor.
+    pixels = list(image.convert('L').resize((9, 8), Image.BOX).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value <<= 1
+            if pixels[row*9 + col + 1] > pixels[row*9 + col]:
+                value |= 1
+    # SQLite integers are signed.
+    return value - 2**64 if value >= 2**63 else value
+
+
+def pack_keyframes(keyframes):
+    return struct.pack('<%dI' % len(keyframes), *keyframes)
+
+
+def unpack_keyframes(data):
+    if data is None:
+        return []
+    return list(struct.unpack('<%dI' % (len(data)//4), data))
@@ -1,18 +1,24 @@
 import re
+from bisect import bisect_left, bisect_right
 from datetime import timedelta
 from urllib.parse import unquote
 
 import flask
 from base64 import b64encode
 
-from knowledgeseeker.database import get_db, match_episode, match_season
+from knowledgeseeker.database import (get_db, lazy_snapshots, match_episode,
+                                      match_season)
+from knowledgeseeker.pagecache import cached_page
 from knowledgeseeker.utils import set_expires, strftimecode, strip_html
 
 
 bp = flask.Blueprint('webui', __name__)
+bp.add_app_template_global(lazy_snapshots)
 
 NAV_STEPS = 3
 CLOSE_SUBTITLE_SECS = 3
+MOMENT_WINDOW = 8
+MAX_MOMENT_WINDOW = 20
 MAX_SEARCH_LENGTH = 80
 N_SEARCH_RESULTS = 50
 
@@ -30,6 +36,7 @@ def about():
 
 
 @bp.route('/<season>/')
+@cached_page
 @match_season
 def browse_season(season_id):
     cur = get_db().cursor()
@@ -77,6 +84,7 @@ def season_icon(season_id):
 
 
 @bp.route('/<season>/<episode>/')
+@cached_page
 @match_episode
 def browse_episode(season_id, episode_id):
     cur = get_db().cursor()
@@ -99,14 +107,41 @@ def browse_episode(season_id, episode_id):
 
     # Retrieve all subtitles.
     cur.execute(
-        'SELECT start_ms, end_ms, snapshot_ms, content FROM subtitle '
-        ' WHERE episode_id=:episode_id ORDER BY start_ms',
+        '   SELECT subtitle.start_ms, subtitle.end_ms, subtitle.snapshot_ms, '
+        '          subtitle.content, sprite.sheet_idx, sprite.x, sprite.y, '
+        '          sprite.width, sprite.height '
+        '          FROM subtitle '
+        'LEFT JOIN sprite ON sprite.episode_id = subtitle.episode_id '
+        '                    AND sprite.ms = subtitle.snapshot_ms '
+        '    WHERE subtitle.episode_id=:episode_id ORDER BY subtitle.start_ms',
         { 'episode_id': episode_id })
     res = cur.fetchall()
     if len(res) == 0:
         flask.abort(404, 'no subtitles found')
     targs['subtitles'] = res
 
+    # Sprites are drawn at the height of the row, so position them in
+    # proportion to the size of their sheet.
+    cur.execute(
+        '  SELECT sheet_idx, MAX(x) + MAX(width) AS width, '
+        '         MAX(y) + MAX(height) AS height '
+        '    FROM sprite WHERE episode_id=:episode_id '
+        'GROUP BY sheet_idx',
+        { 'episode_id': episode_id })
+    sheets = { row['sheet_idx']: (row['width'], row['height'])
+               for row in cur.fetchall() }
+    def sprite_style(row):
+        sheet_w, sheet_h = sheets[row['sheet_idx']]
+        def offset(pos, size, sheet_size):
+            return pos/(sheet_size - size)*100 if sheet_size > size else 0
+        return ('aspect-ratio: %d / %d; background-size: %.4f%% %.4f%%; '
+                'background-position: %.4f%% %.4f%%;'
+                % (row['width'], row['height'],
+                   sheet_w/row['width']*100, sheet_h/row['height']*100,
+                   offset(row['x'], row['width'], sheet_w),
+                   offset(row['y'], row['height'], sheet_h)))
+    targs['sprite_style'] = sprite_style
+
     def str_ms(ms):
         return strftimecode(timedelta(milliseconds=ms))
     targs['str_ms'] = str_ms
@@ -114,6 +149,7 @@ def browse_episode(season_id, episode_id):
 
 
 @bp.route('/<season>/<episode>/<int:ms>/')
+@cached_page
 @match_episode
 def browse_moment(season_id, episode_id, ms):
     cur = get_db().cursor()
@@ -128,57 +164,160 @@ def browse_moment(season_id, episode_id, ms):
     targs['season_has_icon'] = res['icon_png'] is not None
 
     # Retrieve episode information.
-    cur.execute('SELECT slug, name FROM episode WHERE id=:episode_id',
-                { 'episode_id': episode_id })
+    cur.execute(
+        'SELECT slug, name, duration, fps FROM episode WHERE id=:episode_id',
+        { 'episode_id': episode_id })
     res = cur.fetchone()
     targs['episode'] = res['slug']
     targs['episode_name'] = res['name']
 
-    # Locate relevant subtitles.
-    cur.execute(
-        'SELECT content, start_ms, end_ms, snapshot_ms FROM subtitle '
-        ' WHERE episode_id=:episode_id '
-        '       AND MIN(ABS(start_ms-:ms), ABS(end_ms-:ms))<=:ms_range',
-        { 'episode_id': episode_id, 'ms': ms,
-          'ms_range': CLOSE_SUBTITLE_SECS*1000 })
-    subtitles = cur.fetchall()
-    targs['subtitles'] = subtitles
-    targs['current_line'] = next(
-        map(lambda row: strip_html(row['content']),
-            filter(lambda row: ms >= row['start_ms'] and ms <= row['end_ms'],
-                   subtitles)),
-        '')
-
-    # Locate surrounding images.
-    nav_list = [ms]
+    # Any time can be shown if images are rendered on request.
+    targs['scrubber'] = lazy_snapshots()
+    # The scrubber counts frames, so that every step lands on a real one.
+    fps = scrub_fps(res['fps'])
+    targs['fps'] = fps
+    targs['frame'] = round(ms*fps/1000)
+    targs['last_frame'] = max(0, int((res['duration'] - 1)*fps/1000))
+
+    # Locate relevant subtitles and surrounding images.
+    targs.update(find_moments(episode_id, ms)[0])
+
+    targs['encode_text'] = encode_text
+    def str_ms(ms):
+        return strftimecode(timedelta(milliseconds=ms))
+    targs['str_ms'] = str_ms
+    return flask.render_template('moment.html', **targs)
+
+
+@bp.route('/<season>/<episode>/<int:ms>/moment.json')
+@set_expires
+@match_episode
+def moment_json(season_id, episode_id, ms):
+    # What browse_moment shows, for ms and the images around it, so that
+    # pages can step through a scene without reloading.
+    window = max(0, min(flask.request.args.get('window', MOMENT_WINDOW, type=int),
+                        MAX_MOMENT_WINDOW))
+    slug_kwargs = { 'season': flask.request.view_args['season'],
+                    'episode': flask.request.view_args['episode'] }
+    def moment_urls(ms):
+        return { 'url': flask.url_for('webui.browse_moment', ms=ms, **slug_kwargs),
+                 'json': flask.url_for('webui.moment_json', ms=ms, **slug_kwargs),
+                 'tiny': flask.url_for('clips.snapshot_tiny', ms=ms, **slug_kwargs) }
+
+    moments = []
+    for moment in find_moments(episode_id, ms, window=window):
+        ms = moment['ms']
+        subtitles = []
+        for row in moment['subtitles']:
+            subtitles.append({
+                'ms': row['snapshot_ms'],
+                'content': row['content'],
+                'now': ms >= row['start_ms'] and ms <= row['end_ms'],
+                'url': (flask.url_for('webui.browse_moment',
+                                      ms=row['snapshot_ms'], **slug_kwargs)
+                        if row['snapshot_ms'] is not None else None) })
+        moments.append({
+            'ms': ms,
+            'current_line': moment['current_line'],
+            'subtitles': subtitles,
+            'nav': [dict(ms=nav_ms, **moment_urls(nav_ms))
+                    for nav_ms in moment['nav_list']],
+            'snapshot': flask.url_for('clips.snapshot', ms=ms, **slug_kwargs),
+            'snapshot_sub': flask.url_for(
+                'clips.snapshot', ms=ms,
+                btmb64=encode_text(moment['current_line']), **slug_kwargs),
+            **moment_urls(ms) })
+    response = flask.jsonify(moments=moments)
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+
+def find_moments(episode_id, ms, window=0):
+    # The subtitles and images around ms, and around each of the window
+    # images on either side of it, from one query per table.
+    cur = get_db().cursor()
+    reach = window + NAV_STEPS
     cur.execute(
-        '  SELECT ms FROM snapshot WHERE episode_id=:episode_id AND ms<:ms '
+        '  SELECT ms FROM snapshot WHERE episode_id=:episode_id AND ms<=:ms '
         'ORDER BY ms DESC LIMIT :steps',
-        { 'episode_id': episode_id, 'ms': ms, 'steps': NAV_STEPS })
-    nav_list += [row['ms'] for row in cur.fetchall()]
+        { 'episode_id': episode_id, 'ms': ms, 'steps': reach + 1 })
+    before = [row['ms'] for row in cur.fetchall()]
+    is_image = before[:1] == [ms]
+    before = [before_ms for before_ms in before if before_ms != ms][:reach]
+    before.reverse()
     cur.execute(
         '  SELECT ms FROM snapshot WHERE episode_id=:episode_id AND ms>:ms '
         'ORDER BY ms ASC LIMIT :steps',
-        { 'episode_id': episode_id, 'ms': ms, 'steps': NAV_STEPS })
-    nav_list += [row['ms'] for row in cur.fetchall()]
-    nav_list.sort()
-    targs['nav_list'] = nav_list
+        { 'episode_id': episode_id, 'ms': ms, 'steps': reach })
+    after = [row['ms'] for row in cur.fetchall()]
+    images = before + ([ms] if is_image else []) + after
+    targets = before[max(0, len(before) - window):] + [ms] + after[:window]
 
-    def encode_text(content):
-        return b64encode(strip_html(content).encode('utf-8'))
-    targs['encode_text'] = encode_text
-    return flask.render_template('moment.html', **targs)
-
-
-@bp.route('/search')
-def search():
-    query = flask.request.args.get('q')
+    ms_range = CLOSE_SUBTITLE_SECS*1000
+    cur.execute(
+        'SELECT content, start_ms, end_ms, snapshot_ms FROM subtitle '
+        ' WHERE episode_id=:episode_id '
+        '       AND end_ms>=:first_ms AND start_ms<=:last_ms',
+        { 'episode_id': episode_id, 'first_ms': targets[0] - ms_range,
+          'last_ms': targets[-1] + ms_range })
+    rows = cur.fetchall()
+
+    moments = []
+    for target in targets:
+        subtitles = [row for row in rows
+                     if min(abs(row['start_ms'] - target),
+                            abs(row['end_ms'] - target)) <= ms_range]
+        current_line = next(
+            map(lambda row: strip_html(row['content']),
+                filter(lambda row: (target >= row['start_ms']
+                                    and target <= row['end_ms']),
+                       subtitles)),
+            '')
+        lo = bisect_left(images, target)
+        hi = bisect_right(images, target)
+        nav_list = (images[max(0, lo - NAV_STEPS):lo] + [target]
+                    + images[hi:hi + NAV_STEPS])
+        moments.append({ 'ms': target,
+                         'subtitles': subtitles,
+                         'current_line': current_line,
+                         'nav_list': nav_list })
+    return moments
+
+
+def clean_query(query):
     if query is None:
         query = ''
 
     query = unquote(query)
     query = re.sub(r'[^a-zA-Z0-9 \']', '', query)
-    query = query[0:MAX_SEARCH_LENGTH]
+    return query[0:MAX_SEARCH_LENGTH]
+
+
+def encode_text(content):
+    return b64encode(strip_html(content).encode('utf-8'))
+
+
+def scrub_fps(fps):
+    # Step by milliseconds if the frame rate is unknown.
+    return fps if fps is not None else 1000
+
+
+@bp.route('/<season>/<episode>/scrub')
+@match_episode
+def scrub(season_id, episode_id):
+    cur = get_db().cursor()
+    cur.execute('SELECT fps FROM episode WHERE id=:episode_id',
+                { 'episode_id': episode_id })
+    fps = scrub_fps(cur.fetchone()['fps'])
+    frame = max(0, flask.request.args.get('frame', 0, type=int))
+    return flask.redirect(flask.url_for(
+        'webui.browse_moment', season=flask.request.view_args['season'],
+        episode=flask.request.view_args['episode'], ms=round(frame*1000/fps)))
+
+
+@bp.route('/search')
+def search():
+    query = clean_query(flask.request.args.get('q'))
     if query == '':
         return flask.render_template('search.html', query='')
 
@@ -7,6 +7,18 @@ from pathlib import Path
 
 ## All episodes, their video files, and their subtitle files.
 LIBRARY = Path('library/atla.json')
+# Database built from them.
+DATABASE = 'data.db'
+# Alternatively, serve several shows, each under its own URL prefix and with
+# its own library and database. Overrides LIBRARY and DATABASE.
+#LIBRARIES = {
+#    'atla': { 'NAME': 'Avatar: The Last Airbender',
+#              'LIBRARY': Path('library/atla.json'),
+#              'DATABASE': 'atla.db' },
+#    'korra': { 'NAME': 'The Legend of Korra',
+#               'LIBRARY': Path('library/korra.json'),
+#               'DATABASE': 'korra.db' } }
+LIBRARIES = None
 
 ## Jpeg snapshots and subtitling.
 JPEG_VRES = 720
@@ -15,6 +27,15 @@ JPEG_TINY_VRES = 100
 PIL_FONT = Path('library/fonts/Herculanum.wolff')
 PIL_FONT_SIZE = 60
 PIL_MAXWIDTH = 30
+# Additional snapshot formats to encode at ingest and offer to browsers that
+# accept them. Formats Pillow cannot write are skipped.
+SNAPSHOT_FORMATS = ['webp', 'avif']
+# Skip frames at least this structurally similar (0-1) to the last saved
+# frame, e.g. 0.98. None keeps every frame the classifier picks.
+DEDUPE_SSIM = None
+# Store only the times of snapshots and have ffmpeg render images on request,
+# for any time in an episode. Builds a much smaller database much faster.
+LAZY_SNAPSHOTS = False
 
 ## Paths to ffmpeg binaries.
 FFMPEG_PATH = 'ffmpeg'
@@ -30,6 +51,28 @@ FF_FONT_DIR = Path('library/fonts/')
 # ...and its filename, without the extension.
 FF_FONT_NAME = 'Herculanum'
 FF_FONT_SIZE = 24
+# Rendered animations are kept on disk so they can be served with a length
+# and in ranges; remove the least recently used beyond this many bytes.
+MEDIA_CACHE_SIZE = 2*1024**3
+
+## Reverse screenshot search.
+# Index hashes in chunks to avoid a full scan; worth it for large libraries.
+FRAME_SEARCH_MULTI_INDEX = False
+# Largest screenshot accepted, in pixels.
+FRAME_SEARCH_MAX_PIXELS = 4096*4096
 
 ## Server options.
 HTTP_CACHE_EXPIRES = timedelta(days=7)
+# Largest request body accepted, such as an uploaded screenshot.
+MAX_CONTENT_LENGTH = 16*1024**2
+# Open the database and fill caches when a worker starts.
+PRELOAD = False
+# Number of rendered season, episode, and moment pages to keep in memory.
+PAGE_CACHE_SIZE = 1024
+# Serve pages pre-rendered by the render-pages command, if available.
+PAGE_CACHE_DISK = True
+# Threads available to views when serving through knowledgeseeker.asgi; ffmpeg
+# runs outside of them.
+ASGI_THREADS = 8
+# Maximum concurrent ffmpeg transcodes under ASGI, or None for no limit.
+ASGI_MAX_TRANSCODES = None
@@ -0,0 +1,6 @@
+#!/usr/bin/python3
+import uvicorn
+from knowledgeseeker.asgi import create_asgi_app
+
+if __name__ == '__main__':
+    uvicorn.run(create_asgi_app(), uds='/run/knowledge-seeker.sock')
@@ -9,8 +9,11 @@ setup(
     install_requires=[
         'flask',
         'ffmpeg-python',
-        'opencv-python-headless',
-        'Pillow',
-        'srt'
+        'numpy',
+        'Pillow'
     ],
+    extras_require={
+        'asgi': ['uvicorn'],
+        'ingest': ['opencv-python-headless', 'srt']
+    },
 )